@@ -17,18 +17,29 @@ import os
 import re
 import io
 import json
+import atexit
 import difflib
+import functools
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from typing import Optional, Dict, List, Tuple, Any
 
 from flask import Flask, request, abort
+import requests
+from requests.adapters import HTTPAdapter
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 
+from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+
 from linebot import LineBotApi, WebhookHandler
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from classplus_handler import parse_student_info, run_classplus_task, format_result_message
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
@@ -36,6 +47,12 @@ from linebot.models import (
     TextSendMessage,
 )
 
+@functools.lru_cache(maxsize=1)
+def _service_account_info() -> Optional[Dict[str, Any]]:
+    """解析環境變數中的服務帳號 JSON（Vision 與 Sheets 共用，只解析一次）"""
+    sa_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON_NEW", "")
+    return json.loads(sa_json) if sa_json else None
+
 # ====== Vision OCR 初始化（修復 S1）======
 _HAS_VISION = False
 _vision_client = None
@@ -54,9 +71,8 @@ def _init_vision_client():
             _HAS_VISION = True
             return
         
-        sa_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON_NEW", "")
-        if sa_json:
-            info = json.loads(sa_json)
+        info = _service_account_info()
+        if info:
             creds = gcp_service_account.Credentials.from_service_account_info(info)
             _vision_client = vision.ImageAnnotatorClient(credentials=creds)
             _HAS_VISION = True
@@ -86,8 +102,13 @@ WHITELIST_SHEET_NAME = os.getenv("WHITELIST_SHEET_NAME", "白名單")
 CANDIDATE_SHEET_NAME = os.getenv("CANDIDATE_SHEET_NAME", "候選名單")
 WHITELIST_MODE = os.getenv("WHITELIST_MODE", "enforce").strip().lower()
 ADMIN_USER_IDS = {x.strip() for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()}
-_WHITELIST_CACHE = {"ts": 0.0, "set": set()}
+_WHITELIST_CACHE = {"ts": 0.0, "set": set(), "refreshing": False}
+_WHITELIST_LOCK = threading.Lock()
 _WHITELIST_TTL = 300
+CANDIDATE_FLUSH_SEC = int(os.getenv("CANDIDATE_FLUSH_SEC", "300"))  # 候選名單 last_seen 批次回寫間隔
+_CANDIDATE_PENDING: Dict[str, Tuple[str, str, str]] = {}  # user_id -> (name, first_seen, last_seen)，等待回寫
+_CANDIDATE_KNOWN: set = set()  # 已確認在候選名單中有列的 user_id
+_CANDIDATE_LOCK = threading.Lock()
 
 # === 新增常數定義（修復 L1）===
 FUZZY_THRESHOLD = float(os.getenv("FUZZY_THRESHOLD", "0.7"))
@@ -95,10 +116,15 @@ QUERY_DAYS = int(os.getenv("QUERY_DAYS", "30"))
 PHONE_SUFFIX_MATCH = int(os.getenv("PHONE_SUFFIX_MATCH", "9"))
 WRITE_ZIP_TO_ADDRESS = os.getenv("WRITE_ZIP_TO_ADDRESS", "true").lower() == "true"
 LOG_OCR_RAW = os.getenv("LOG_OCR_RAW", "true").lower() == "true"
+LOG_WEBHOOK_RAW = os.getenv("LOG_WEBHOOK_RAW", "false").lower() == "true"  # 記錄完整 webhook 內容（除錯用）
 OCR_SESSION_TTL_MIN = int(os.getenv("OCR_SESSION_TTL_MIN", "10"))
+OCR_LANGUAGE_HINTS = [x.strip() for x in os.getenv("OCR_LANGUAGE_HINTS", "zh-Hant,en").split(",") if x.strip()]
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "8"))  # 背景處理執行緒數
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))  # gunicorn 請求執行緒數（與 gunicorn.conf.py 相同）
 MAX_BOOK_SUGGESTIONS = 3  # 最多建議書籍數量
 MAX_LEFTOVER_ITEMS = 10   # OCR 未配對項目最多顯示數量
-INSERT_AT_TOP = True  # 固定在第二列插入新資料
+# 新資料插入第二列（上新下舊）；大表可設 false 改為附加在表尾，免去伺服器端整表下移
+INSERT_AT_TOP = os.getenv("INSERT_AT_TOP", "true").lower() == "true"
 
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
@@ -106,16 +132,136 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 if not LINE_CHANNEL_SECRET or not LINE_CHANNEL_ACCESS_TOKEN:
     raise RuntimeError("Missing LINE credentials.")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# LINE API 共用連線池（SDK 預設每次呼叫 requests.post，回覆/推播都要重新握手 TLS）
+# 請求執行緒（回覆）與背景執行緒（推播、下載圖片）都會同時使用，連線數取兩者總和
+_LINE_SESSION = requests.Session()
+_LINE_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=WEB_THREADS + WORKER_THREADS + 2))
+
+class _PooledLineHttpClient(RequestsHttpClient):
+    """讓 LineBotApi 透過 _LINE_SESSION 發送請求（沿用 keep-alive 連線）"""
+
+    def _request(self, method, url, timeout=None, **kw):
+        response = _LINE_SESSION.request(
+            method, url, timeout=self.timeout if timeout is None else timeout, **kw
+        )
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=_PooledLineHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 TZ = ZoneInfo("Asia/Taipei")
 
+# ---- 預先編譯的正規表示式（避免每次呼叫都查 re 內部快取）----
+_RE_HAS_DIGIT = re.compile(r"\d")
+_RE_WHITESPACE = re.compile(r"\s+")
+_RE_RID = re.compile(r"R\d{4}", re.IGNORECASE)
+_RE_RID_NUM = re.compile(r"R(\d+)")
+_RE_NUM12 = re.compile(r"\d{12}")
+_RE_BOOK_SPLIT = re.compile(r"[,，、;；\n]+")
+_RE_CANCEL_CMD = re.compile(r"^#(取消寄書|刪除寄書)\s*")
+_RE_QUERY_CMD = re.compile(r"^#(查詢寄書|查寄書)\s*")
+_RE_QTY_SEP = re.compile(r"[*×xX]")
+_RE_DT_MIN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}")
+
 # ============================================
 # 全域狀態管理（修復 H1：使用 user_id 隔離）
 # ============================================
 _PENDING: Dict[str, Dict[str, Any]] = {}  # user_id -> pending_data
+_PENDING_LOCK = threading.Lock()  # 背景執行緒也會讀寫 _PENDING，確認動作需原子地認領
+PENDING_TTL_SEC = int(os.getenv("PENDING_TTL_SEC", "1800"))  # 未回覆的確認流程保留時間
+_PENDING_MAX = 1000  # 同時保留的確認流程上限（超過時捨棄最早到期的）
 _OCR_SESSIONS: Dict[str, float] = {}  # user_id -> expire_timestamp
+_OCR_LOCK = threading.Lock()
+
+# ============================================
+# 回覆與背景處理（webhook 只負責分派，Sheets/OCR 交給執行緒池）
+# ============================================
+_EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="webhook")
+_WORKER_CTX = threading.local()  # 背景執行緒目前處理的事件（該事件的 reply token 已用於回覆處理中）
+
+def _push_target(event) -> str:
+    """push 對象（群組優先，否則個人）"""
+    uid = getattr(event.source, "user_id", "")
+    return getattr(event.source, "group_id", uid) or uid
+
+def _reply(event, text: str):
+    """回覆文字訊息（已回覆過「處理中」的事件改用 push）"""
+    if getattr(_WORKER_CTX, "event", None) is event:
+        line_bot_api.push_message(_push_target(event), TextSendMessage(text=text))
+    else:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+
+def _run_deferred(event, func, *args):
+    """背景執行處理函式（例外只記錄，與 callback 原本行為一致）"""
+    _WORKER_CTX.event = event
+    try:
+        func(event, *args)
+    except Exception as e:
+        app.logger.exception(f"[WORKER] {func.__name__} 失敗: {e}")
+    finally:
+        _WORKER_CTX.event = None
+
+def _defer(event, func, *args, ack: str = "⏳ 處理中，請稍候..."):
+    """先用 reply token 回覆處理中，再把實際工作交給背景執行緒"""
+    try:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=ack))
+    except Exception as e:
+        app.logger.warning(f"[WORKER] 回覆處理中失敗: {e}")
+    _EXECUTOR.submit(_run_deferred, event, func, *args)
+
+def _set_pending(user_id: str, data: Dict[str, Any]):
+    """寫入待確認資料（順便清除過期項目，避免放棄的流程一直留在記憶體）"""
+    now = time.time()
+    data.setdefault("expire_at", now + PENDING_TTL_SEC)
+    with _PENDING_LOCK:
+        for uid in [u for u, p in _PENDING.items() if now > p["expire_at"]]:
+            _PENDING.pop(uid, None)
+        if user_id not in _PENDING and len(_PENDING) >= _PENDING_MAX:
+            _PENDING.pop(min(_PENDING, key=lambda u: _PENDING[u]["expire_at"]), None)
+        _PENDING[user_id] = data
+
+def _drop_pending(user_id: str):
+    """移除待確認資料（所有寫入與移除都在 _PENDING_LOCK 內，清理過期項目時才不會與其他執行緒衝突）"""
+    with _PENDING_LOCK:
+        _PENDING.pop(user_id, None)
+
+_SEEN_EVENT_TTL = 600  # LINE 回應逾時會重送同一事件，期間內重複的事件直接略過
+_SEEN_EVENTS: Dict[str, float] = {}  # webhook event id -> 到期時間
+_SEEN_LOCK = threading.Lock()
+
+def _is_redelivery(event) -> bool:
+    """同一事件已受理過回傳 True（避免重送造成重複建單或重複 OCR）"""
+    key = getattr(event, "webhook_event_id", None) or getattr(event.message, "id", None)
+    if not key:
+        return False
+    now = time.time()
+    with _SEEN_LOCK:
+        for k in [k for k, exp in _SEEN_EVENTS.items() if now > exp]:
+            del _SEEN_EVENTS[k]
+        if key in _SEEN_EVENTS:
+            return True
+        _SEEN_EVENTS[key] = now + _SEEN_EVENT_TTL
+        return False
+
+def _claim_pending(user_id: str, pend: Dict[str, Any]) -> bool:
+    """認領待確認資料（仍是同一筆才移除並回傳 True，避免連按兩次確認重複寫入）"""
+    with _PENDING_LOCK:
+        if _PENDING.get(user_id) is not pend:
+            return False
+        del _PENDING[user_id]
+        return True
 
 # ============================================
 # Google Sheets 連線（修復 S3：加入錯誤處理）
@@ -132,11 +278,11 @@ def _build_gspread_client():
         creds = Credentials.from_service_account_file(json_path, scopes=SCOPES)
         return gspread.authorize(creds)
     
-    sa_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON_NEW", "")
-    if not sa_json:
+    info = _service_account_info()
+    if not info:
         raise RuntimeError("Missing service account credentials.")
     
-    creds = Credentials.from_service_account_info(json.loads(sa_json), scopes=SCOPES)
+    creds = Credentials.from_service_account_info(info, scopes=SCOPES)
     return gspread.authorize(creds)
 
 def _safe_open_spreadsheet(sheet_id: str):
@@ -156,10 +302,18 @@ except Exception as e:
     app.logger.error(f"[SHEETS] 啟動失敗: {e}")
     ss = None  # 允許服務啟動，但會在操作時報錯
 
+# 工作表物件快取（ss.worksheet 每次都會向 Sheets 取一次 metadata）
+_WS_CACHE: Dict[str, Any] = {}
+
 def _ws(name: str):
     """取得工作表（修復 H2：加入錯誤處理）"""
+    cached = _WS_CACHE.get(name)
+    if cached is not None:
+        return cached
     try:
-        return ss.worksheet(name)
+        ws = ss.worksheet(name)
+        _WS_CACHE[name] = ws
+        return ws
     except gspread.WorksheetNotFound:
         app.logger.error(f"[SHEETS] 工作表不存在: {name}")
         raise ValueError(f"找不到工作表：{name}")
@@ -169,14 +323,21 @@ def _ws(name: str):
 
 def _get_or_create_ws(name: str, headers: list):
     """取得或建立工作表（修復 H2）"""
+    cached = _WS_CACHE.get(name)
+    if cached is not None:
+        return cached
     try:
         ws = ss.worksheet(name)
+        _WS_CACHE[name] = ws
         return ws
     except gspread.WorksheetNotFound:
         try:
             ws = ss.add_worksheet(title=name, rows=200, cols=max(10, len(headers)))
+            _WS_CACHE[name] = ws
             if headers:
-                ws.update(f"A1:{chr(64+len(headers))}1", [headers])
+                # 超過 26 欄時 chr(64+n) 會變成非欄位字元，改用 gspread 的欄位換算
+                ws.update(f"A1:{rowcol_to_a1(1, len(headers))}", [headers])
+                _HEADER_MAP_CACHE.pop(name, None)
             app.logger.info(f"[SHEETS] 已建立工作表: {name}")
             return ws
         except Exception as e:
@@ -186,55 +347,224 @@ def _get_or_create_ws(name: str, headers: list):
         app.logger.error(f"[SHEETS] 取得工作表失敗 {name}: {e}")
         raise
 
+def _forget_ws(ws):
+    """API 呼叫失敗時丟棄快取的工作表物件（可能已被改名、刪除或重建），下次重新取得"""
+    if _WS_CACHE.get(ws.title) is ws:
+        _WS_CACHE.pop(ws.title, None)
+
+HEADER_CACHE_TTL = int(os.getenv("HEADER_CACHE_TTL", "600"))
+_HEADER_MAP_CACHE: Dict[str, Tuple[float, Dict[str, int]]] = {}  # 工作表名稱 -> (讀取時間, 表頭對應)
+
+def _header_map_from_row(header: List[str]) -> Dict[str, int]:
+    """表頭列 -> {欄名: 欄號}"""
+    hmap = {}
+    for idx, title in enumerate(header, start=1):
+        t = str(title).strip()
+        if t:
+            hmap[t] = idx
+    return hmap
+
 def _get_header_map(ws):
-    """取得表頭對應（修復 H2）"""
+    """取得表頭對應（修復 H2；表頭很少變動，依工作表名稱快取）"""
+    hit = _HEADER_MAP_CACHE.get(ws.title)
+    if hit and (time.time() - hit[0] < HEADER_CACHE_TTL):
+        return hit[1]
     try:
-        header = ws.row_values(1)
-        hmap = {}
-        for idx, title in enumerate(header, start=1):
-            t = str(title).strip()
-            if t:
-                hmap[t] = idx
+        hmap = _header_map_from_row(ws.row_values(1))
+        if hmap:
+            _HEADER_MAP_CACHE[ws.title] = (time.time(), hmap)
         return hmap
     except Exception as e:
+        _forget_ws(ws)
         app.logger.error(f"[SHEETS] 取得表頭失敗: {e}")
         return {}
 
+def _invalidate_header_cache(name: Optional[str] = None):
+    """清除表頭對應快取（name 為 None 時清除全部；試算表調整欄位後使用）"""
+    if name is None:
+        _HEADER_MAP_CACHE.clear()
+    else:
+        _HEADER_MAP_CACHE.pop(name, None)
+
 def _col_idx(hmap, key, default_idx):
     """取得欄位索引"""
     return hmap.get(key, default_idx)
 
-def _safe_update_cell(ws, row: int, col: int, value: Any):
-    """安全更新儲存格（修復 H2 + M3）"""
+_MAIN_COLS = {"src": None, "cols": {}}  # 主表常用欄位索引（隨表頭對應快取重建）
+
+def _main_cols(hmap: Dict[str, int]) -> Dict[str, int]:
+    """主表常用欄位索引（支援多種表頭名稱），同一份表頭對應只算一次"""
+    if _MAIN_COLS["src"] is hmap:
+        return _MAIN_COLS["cols"]
+    cols = {
+        "rid": _col_idx(hmap, "紀錄ID", _col_idx(hmap, "寄書ID", 1)),
+        "created": _col_idx(hmap, "建單日期", 2),
+        "name": _col_idx(hmap, "學員姓名", _col_idx(hmap, "姓名", 4)),
+        "phone": _col_idx(hmap, "學員電話", _col_idx(hmap, "電話", 5)),
+        "book": _col_idx(hmap, "書籍名稱", 7),
+        "note": _col_idx(hmap, "業務備註", _col_idx(hmap, "備註", 8)),
+        "ship_date": _col_idx(hmap, "寄出日期", _col_idx(hmap, "已託運-寄出日期", 10)),
+        "tracking": _col_idx(hmap, "託運單號", _col_idx(hmap, "已託運-12碼單號", 11)),
+        "person": _col_idx(hmap, "經手人", _col_idx(hmap, "已託運-經手人", 12)),
+        "status": _col_idx(hmap, "寄送狀態", _col_idx(hmap, "狀態", 13)),
+    }
+    _MAIN_COLS.update({"src": hmap, "cols": cols})
+    return cols
+
+# ============================================
+# 工作表讀取快取（每次 get_all_values 都是一次完整 HTTP 往返）
+# ============================================
+SHEET_CACHE_TTL = int(os.getenv("SHEET_CACHE_TTL", "60"))
+ROW_LOOKUP_TTL = int(os.getenv("ROW_LOOKUP_TTL", "10"))  # 主表查詢/定位列號用，較短以免列號過期
+_SHEET_CACHE: Dict[str, Tuple[float, List[List[str]]]] = {}  # 工作表名稱 -> (讀取時間, 全表資料)
+_SHEET_GEN: Dict[str, int] = {}  # 工作表名稱 -> 寫入世代（每次清除快取 +1）
+_SHEET_LOCKS: Dict[str, threading.Lock] = {}  # 每張表一把鎖，同一張表同時只讀一次
+_SHEET_WRITE_LOCKS: Dict[str, threading.RLock] = {}  # 每張表一把寫入鎖：定位列號到寫入完成之間持有
+_COLUMN_CACHE: Dict[Tuple[str, Tuple[int, ...]], Tuple[float, int, List[List[str]]]] = {}  # (工作表名稱, 欄號) -> (讀取時間, 寫入世代, 只含指定欄的資料)
+
+def _cached_values(ws, ttl: int = SHEET_CACHE_TTL) -> List[List[str]]:
+    """讀取整張工作表（TTL 內直接回傳快取）"""
+    hit = _SHEET_CACHE.get(ws.title)
+    if hit and (time.time() - hit[0] < ttl):
+        return hit[1]
+    with _SHEET_LOCKS.setdefault(ws.title, threading.Lock()):
+        # 取得鎖後再檢查一次，其他執行緒可能已經讀好了
+        now = time.time()
+        hit = _SHEET_CACHE.get(ws.title)
+        if hit and (now - hit[0] < ttl):
+            return hit[1]
+        gen = _SHEET_GEN.get(ws.title, 0)
+        try:
+            values = ws.get_all_values()
+        except Exception:
+            _forget_ws(ws)
+            raise
+        # 讀取期間若有寫入，這份資料可能已過期，不放進快取
+        if _SHEET_GEN.get(ws.title, 0) == gen:
+            _SHEET_CACHE[ws.title] = (now, values)
+        # 表頭就是第一列，順便更新表頭快取，之後不必再單獨讀 row_values(1)
+        hmap = _header_map_from_row(values[0]) if values else {}
+        if hmap:
+            _HEADER_MAP_CACHE[ws.title] = (now, hmap)
+        return values
+
+def _sheet_write_lock(name: str) -> threading.RLock:
+    """取得工作表的寫入鎖（插入列會讓下方列號全部位移，依列號寫入前必須持有）"""
+    return _SHEET_WRITE_LOCKS.setdefault(name, threading.RLock())
+
+def _invalidate_sheet_cache(name: str):
+    """寫入後清除該工作表的讀取快取"""
+    _SHEET_GEN[name] = _SHEET_GEN.get(name, 0) + 1
+    _SHEET_CACHE.pop(name, None)
+
+def _cached_columns(ws, col_ids: Tuple[int, ...], ttl: int = SHEET_CACHE_TTL) -> List[List[str]]:
+    """只讀取指定欄（按欄 batch_get 後轉回列；第 k 欄對應 col_ids[k]，列號與整表相同）"""
+    key = (ws.title, col_ids)
+    hit = _COLUMN_CACHE.get(key)
+    gen = _SHEET_GEN.get(ws.title, 0)
+    now = time.time()
+    if hit and hit[1] == gen and (now - hit[0] < ttl):
+        return hit[2]
+    letters = [rowcol_to_a1(1, c)[:-1] for c in col_ids]
+    try:
+        ranges = ws.batch_get([f"{x}1:{x}" for x in letters], major_dimension="COLUMNS")
+    except Exception:
+        _forget_ws(ws)
+        raise
+    # 每欄尾端空白會被省略，補齊成同樣列數
+    columns = [vr[0] if vr else [] for vr in ranges]
+    height = max(map(len, columns), default=0)
+    rows = [[c[i] if i < len(c) else "" for c in columns] for i in range(height)]
+    # 讀取期間若有寫入，這份資料可能已過期，不放進快取
+    if _SHEET_GEN.get(ws.title, 0) == gen:
+        _COLUMN_CACHE[key] = (now, gen, rows)
+    return rows
+
+def _records_from_values(values: List[List[str]]) -> List[Dict[str, str]]:
+    """將全表資料轉為 list[dict]（同 get_all_records，但保留原始字串）"""
+    if not values:
+        return []
+    header = [str(h).strip() for h in values[0]]
+    return [dict(zip(header, r + [""] * (len(header) - len(r)))) for r in islice(values, 1, None)]
+
+# 索引以 (來源資料, 欄號, 對照表) 整組替換，並行讀取時不會拿到來源與對照表不一致的組合
+_RID_INDEX = {"entry": (None, 0, {})}  # 對照表: 寄書ID -> [列號, ...]（隨主表讀取快取重建）
+
+def _rid_row_index(all_vals: List[List[str]], idx_rid: int) -> Dict[str, List[int]]:
+    """取得 寄書ID -> 列號清單（同一份快取資料只建一次，供取消、撤銷出書、OCR 回寫共用）"""
+    src, col, cached = _RID_INDEX["entry"]
+    if src is all_vals and col == idx_rid:
+        return cached
+    rows: Dict[str, List[int]] = {}
+    for i, r in enumerate(islice(all_vals, 1, None), start=2):
+        rid = r[idx_rid - 1].strip() if len(r) >= idx_rid else ""
+        if rid:
+            rows.setdefault(rid, []).append(i)
+    _RID_INDEX["entry"] = (all_vals, idx_rid, rows)
+    return rows
+
+_PHONE_INDEX = {"entry": (None, 0, {})}  # 對照表: 電話後 N 碼 -> [列號, ...]
+
+def _phone_suffix_index(all_vals: List[List[str]], idx_phone: int) -> Dict[str, List[int]]:
+    """取得 電話後 PHONE_SUFFIX_MATCH 碼 -> 列號清單（同一份快取資料只建一次）"""
+    src, col, cached = _PHONE_INDEX["entry"]
+    if src is all_vals and col == idx_phone:
+        return cached
+    rows: Dict[str, List[int]] = {}
+    for i, r in enumerate(islice(all_vals, 1, None), start=2):
+        digits = _digits_only(r[idx_phone - 1]) if len(r) >= idx_phone else ""
+        if len(digits) >= PHONE_SUFFIX_MATCH:
+            rows.setdefault(digits[-PHONE_SUFFIX_MATCH:], []).append(i)
+    _PHONE_INDEX["entry"] = (all_vals, idx_phone, rows)
+    return rows
+
+def _safe_insert_rows(ws, rows_data: list):
+    """安全批次插入多列（一次 API 呼叫；INSERT_AT_TOP 時插入第二列，不繼承格式）
+
+    插入會讓下方列號位移，與依列號寫入共用同一把寫入鎖
+    """
     try:
-        ws.update_cell(row, col, value)
-        app.logger.info(f"[SHEETS] 更新 {ws.title} R{row}C{col} = {value}")
+        with _sheet_write_lock(ws.title):
+            if INSERT_AT_TOP:
+                # 在第 2 列（表頭下方）插入新資料
+                # inheritFromBefore=False 確保不繼承上方格式
+                ws.insert_rows(rows_data, row=2, value_input_option="USER_ENTERED", inherit_from_before=False)
+                app.logger.info(f"[SHEETS] 批次插入 {len(rows_data)} 列至 {ws.title} 第2列")
+            else:
+                ws.append_rows(rows_data, value_input_option="USER_ENTERED")
+                app.logger.info(f"[SHEETS] 批次新增 {len(rows_data)} 列至 {ws.title}")
+            _invalidate_sheet_cache(ws.title)
     except Exception as e:
-        app.logger.error(f"[SHEETS] 更新失敗 R{row}C{col}: {e}")
+        _forget_ws(ws)
+        app.logger.error(f"[SHEETS] 批次插入失敗: {e}")
         raise
 
-def _safe_append_row(ws, row_data: list):
-    """安全新增列（固定插入第二列，不繼承格式）"""
+def _safe_batch_update(ws, updates: list):
+    """安全批次更新多個範圍（updates: [{"range": "B2", "values": [[...]]}]，一次 API 呼叫）
+
+    列號需在同一把寫入鎖內取得才可靠；這裡再取一次鎖，確保寫入期間不會有插入
+    """
+    if not updates:
+        return
     try:
-        if INSERT_AT_TOP:
-            # 在第 2 列（表頭下方）插入新資料
-            # inheritFromBefore=False 確保不繼承上方格式
-            ws.insert_row(row_data, index=2, value_input_option="USER_ENTERED", inherit_from_before=False)
-            app.logger.info(f"[SHEETS] 插入列至 {ws.title} 第2列: {row_data[:3]}...")
-        else:
-            # 在最下面新增（保留原邏輯，但目前不使用）
-            ws.append_row(row_data, value_input_option="USER_ENTERED")
-            app.logger.info(f"[SHEETS] 新增列至 {ws.title}: {row_data[:3]}...")
+        with _sheet_write_lock(ws.title):
+            ws.batch_update(updates, value_input_option="USER_ENTERED")
+            _invalidate_sheet_cache(ws.title)
+        app.logger.info(f"[SHEETS] 批次更新 {ws.title} {len(updates)} 個範圍")
     except Exception as e:
-        app.logger.error(f"[SHEETS] 新增列失敗: {e}")
+        _forget_ws(ws)
+        app.logger.error(f"[SHEETS] 批次更新失敗: {e}")
         raise
 
 def _safe_append_rows(ws, rows_data: list):
     """安全批次新增列（修復 H2 + M3）"""
     try:
-        ws.append_rows(rows_data, value_input_option="USER_ENTERED")
+        with _sheet_write_lock(ws.title):
+            ws.append_rows(rows_data, value_input_option="USER_ENTERED")
+            _invalidate_sheet_cache(ws.title)
         app.logger.info(f"[SHEETS] 批次新增 {len(rows_data)} 列至 {ws.title}")
     except Exception as e:
+        _forget_ws(ws)
         app.logger.error(f"[SHEETS] 批次新增失敗: {e}")
         raise
 
@@ -246,64 +576,172 @@ def _truthy(v) -> bool:
     s = str(v).strip().lower()
     return s in ("1", "true", "yes", "y", "t", "啟用", "是", "enabled", "on")
 
+def _refresh_whitelist_in_background():
+    """在背景重新載入白名單（同時只排一個）"""
+    with _WHITELIST_LOCK:
+        if _WHITELIST_CACHE["refreshing"]:
+            return
+        _WHITELIST_CACHE["refreshing"] = True
+
+    def _done():
+        with _WHITELIST_LOCK:
+            _WHITELIST_CACHE["refreshing"] = False
+
+    def _task():
+        try:
+            _load_whitelist(force=True)
+        finally:
+            _done()
+
+    try:
+        _EXECUTOR.submit(_task)
+    except RuntimeError as e:
+        # 執行緒池已關閉（程式結束中）：清除旗標，否則之後再也不會重新載入
+        _done()
+        app.logger.warning(f"[WHITELIST] 無法排入背景重新載入: {e}")
+
 def _load_whitelist(force: bool = False) -> set:
-    """載入白名單（修復 H3：支援強制刷新）"""
+    """載入白名單（修復 H3：支援強制刷新）
+
+    快取過期但仍有舊資料時，先回傳舊資料並在背景重新載入，訊息不必等 Sheets 讀取
+    """
     now = time.time()
-    if (not force) and _WHITELIST_CACHE["set"] and (now - _WHITELIST_CACHE["ts"] < _WHITELIST_TTL):
+    if (not force) and _WHITELIST_CACHE["set"]:
+        if now - _WHITELIST_CACHE["ts"] >= _WHITELIST_TTL:
+            _refresh_whitelist_in_background()
         return _WHITELIST_CACHE["set"]
-    
-    try:
-        ws = _get_or_create_ws(WHITELIST_SHEET_NAME, ["user_id", "name", "enabled"])
-        rows = ws.get_all_records()
-        enabled = {
-            str(r.get("user_id", "")).strip() 
-            for r in rows 
-            if str(r.get("user_id", "")).strip() and _truthy(r.get("enabled", "1"))
-        }
-        _WHITELIST_CACHE["set"] = enabled
-        _WHITELIST_CACHE["ts"] = now
-        app.logger.info(f"[WHITELIST] 已載入 {len(enabled)} 個授權使用者")
-        return enabled
-    except Exception as e:
-        app.logger.error(f"[WHITELIST] 載入失敗: {e}")
-        return _WHITELIST_CACHE["set"]  # 回傳舊快取
+
+    with _WHITELIST_LOCK:
+        # 取得鎖後再檢查一次，避免多個執行緒同時重新載入
+        now = time.time()
+        if (not force) and _WHITELIST_CACHE["set"] and (now - _WHITELIST_CACHE["ts"] < _WHITELIST_TTL):
+            return _WHITELIST_CACHE["set"]
+
+        try:
+            ws = _get_or_create_ws(WHITELIST_SHEET_NAME, ["user_id", "name", "enabled"])
+            if force:
+                _invalidate_sheet_cache(ws.title)
+            rows = _records_from_values(_cached_values(ws, ttl=_WHITELIST_TTL))
+            enabled = {
+                str(r.get("user_id", "")).strip() 
+                for r in rows 
+                if str(r.get("user_id", "")).strip() and _truthy(r.get("enabled", "1"))
+            }
+            _WHITELIST_CACHE.update({"ts": now, "set": enabled})
+            app.logger.info(f"[WHITELIST] 已載入 {len(enabled)} 個授權使用者")
+            return enabled
+        except Exception as e:
+            app.logger.error(f"[WHITELIST] 載入失敗: {e}")
+            return _WHITELIST_CACHE["set"]  # 回傳舊快取
+
+_CANDIDATE_INDEX = {"entry": (None, 0, {})}  # 對照表: user_id -> 列號（隨候選名單讀取快取重建）
+
+def _candidate_row_index(all_vals: List[List[str]], idx_uid: int) -> Dict[str, int]:
+    """取得 user_id -> 列號 的對照表（同一份快取資料只建一次；同 ID 多列時取第一列）"""
+    src, col, cached = _CANDIDATE_INDEX["entry"]
+    if src is all_vals and col == idx_uid:
+        return cached
+    rows = {}
+    for i, r in enumerate(islice(all_vals, 1, None), start=2):
+        if len(r) >= idx_uid:
+            rows.setdefault(r[idx_uid - 1], i)
+    _CANDIDATE_INDEX["entry"] = (all_vals, idx_uid, rows)
+    return rows
 
 def _log_candidate(user_id: str, name: str):
-    """記錄候選名單（修復 H2）"""
+    """記錄候選名單（只寫入記憶體；新使用者立即交給背景執行緒寫入，其餘定期回寫）"""
+    now_s = datetime.now(TZ).strftime("%Y-%m-%d %H:%M")
+    with _CANDIDATE_LOCK:
+        prev = _CANDIDATE_PENDING.get(user_id)
+        is_new = user_id not in _CANDIDATE_KNOWN and prev is None
+        _CANDIDATE_PENDING[user_id] = (name, prev[1] if prev else now_s, now_s)
+    if is_new:
+        # 可能是新使用者，管理員要立即看得到要開通的 ID
+        _EXECUTOR.submit(_flush_candidates)
+
+def _flush_candidates():
+    """將累積的紀錄寫回候選名單：已存在的更新 last_seen/name，新使用者新增一列
+
+    在寫入鎖內重新讀取 user_id 欄再定位列號：並行的首次訊息不會重複新增，手動刪列後也不會寫到別人的列
+    """
+    with _CANDIDATE_LOCK:
+        if not _CANDIDATE_PENDING:
+            return
+        pending = dict(_CANDIDATE_PENDING)
+        _CANDIDATE_PENDING.clear()
     try:
         ws = _get_or_create_ws(CANDIDATE_SHEET_NAME, ["user_id", "name", "first_seen", "last_seen"])
-        all_vals = ws.get_all_values()
-        h = _get_header_map(ws)
-        idx_uid = _col_idx(h, "user_id", 1)
-        idx_name = _col_idx(h, "name", 2)
-        idx_first = _col_idx(h, "first_seen", 3)
-        idx_last = _col_idx(h, "last_seen", 4)
-
-        exists_row = None
-        for i, r in enumerate(all_vals[1:], start=2):
-            if (len(r) >= idx_uid) and r[idx_uid - 1] == user_id:
-                exists_row = i
-                break
-
-        now_s = datetime.now(TZ).strftime("%Y-%m-%d %H:%M")
-        if exists_row:
-            if name:
-                _safe_update_cell(ws, exists_row, idx_name, name)
-            _safe_update_cell(ws, exists_row, idx_last, now_s)
-        else:
-            _safe_append_row(ws, [user_id, name, now_s, now_s])
+        with _sheet_write_lock(ws.title):
+            h = _get_header_map(ws)
+            idx_uid = _col_idx(h, "user_id", 1)
+            idx_name = _col_idx(h, "name", 2)
+            idx_first = _col_idx(h, "first_seen", 3)
+            idx_last = _col_idx(h, "last_seen", 4)
+
+            row_index = _candidate_row_index(_cached_columns(ws, (idx_uid,), ttl=0), 1)
+            updates = []
+            new_rows = []
+            for uid, (name, first_seen, last_seen) in pending.items():
+                i = row_index.get(uid)
+                if i:
+                    updates.append({"range": rowcol_to_a1(i, idx_last), "values": [[last_seen]]})
+                    if name:
+                        updates.append({"range": rowcol_to_a1(i, idx_name), "values": [[name]]})
+                else:
+                    row = [""] * max(idx_uid, idx_name, idx_first, idx_last)
+                    row[idx_uid - 1] = uid
+                    row[idx_name - 1] = name
+                    row[idx_first - 1] = first_seen
+                    row[idx_last - 1] = last_seen
+                    new_rows.append(row)
+            # 先依列號更新，再新增（插入第二列會讓列號位移）
+            _safe_batch_update(ws, updates)
+            if new_rows:
+                _safe_insert_rows(ws, new_rows)
+        with _CANDIDATE_LOCK:
+            _CANDIDATE_KNOWN.update(pending)
+        app.logger.info(f"[CANDIDATE] 已回寫 {len(pending) - len(new_rows)} 位使用者，新增 {len(new_rows)} 位")
     except Exception as e:
-        app.logger.warning(f"[CANDIDATE] 記錄失敗: {e}")
+        app.logger.warning(f"[CANDIDATE] 回寫失敗: {e}")
+        # 放回待寫清單（期間若有更新的紀錄則保留較新的）
+        with _CANDIDATE_LOCK:
+            for uid, item in pending.items():
+                _CANDIDATE_PENDING.setdefault(uid, item)
+
+def _candidate_flush_loop():
+    """背景執行緒：每 CANDIDATE_FLUSH_SEC 秒回寫一次候選名單"""
+    while True:
+        time.sleep(CANDIDATE_FLUSH_SEC)
+        _flush_candidates()
+
+threading.Thread(target=_candidate_flush_loop, name="candidate-flush", daemon=True).start()
+atexit.register(_flush_candidates)
+
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "3600"))
+_PROFILE_CACHE_MAX = 2048
+_PROFILE_CACHE: Dict[str, Tuple[float, str]] = {}  # user_id -> (查詢時間, 顯示名稱)
+
+def _display_name(uid: str, default: str = "系統") -> str:
+    """取得 LINE 顯示名稱（快取 PROFILE_CACHE_TTL 秒，查詢失敗回傳 default 且不快取）"""
+    if not uid:
+        return default
+    now = time.time()
+    hit = _PROFILE_CACHE.get(uid)
+    if hit and (now - hit[0] < PROFILE_CACHE_TTL):
+        return hit[1] or default
+    try:
+        name = line_bot_api.get_profile(uid).display_name or ""
+    except Exception:
+        return default
+    if len(_PROFILE_CACHE) >= _PROFILE_CACHE_MAX:
+        _PROFILE_CACHE.clear()
+    _PROFILE_CACHE[uid] = (now, name)
+    return name or default
 
 def _ensure_authorized(event, scope: str = "*") -> bool:
     """驗證授權（修復 M3：增加日誌）"""
-    try:
-        uid = getattr(event.source, "user_id", "")
-        profile = line_bot_api.get_profile(uid)
-        display_name = profile.display_name or "LINE使用者"
-    except Exception:
-        uid = getattr(event.source, "user_id", "")
-        display_name = "LINE使用者"
+    uid = getattr(event.source, "user_id", "")
+    display_name = _display_name(uid, "LINE使用者")
 
     if uid:
         _log_candidate(uid, display_name)
@@ -325,7 +763,7 @@ def _ensure_authorized(event, scope: str = "*") -> bool:
     if scope == "text":
         msg = f"❌ 尚未授權使用。\n請將此 ID 提供給管理員開通：\n{uid}\n\n（提示：傳「#我的ID」也能取得這串 ID）"
         try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+            _reply(event, msg)
         except Exception:
             pass
     return False
@@ -341,99 +779,162 @@ def today_str():
     """今日日期字串"""
     return datetime.now(TZ).strftime("%Y-%m-%d")
 
+def _dt_sort_key(s: str) -> str:
+    """建單時間排序鍵：yyyy-mm-dd hh:mm 字串可直接依字典序比較，不必逐列 strptime
+
+    非補零格式才退回 strptime；無法解析回傳空字串（排在最舊）
+    """
+    s = s[:16]
+    if _RE_DT_MIN.match(s):
+        return s
+    try:
+        return datetime.strptime(s, "%Y-%m-%d %H:%M").strftime("%Y-%m-%d %H:%M")
+    except ValueError:
+        return ""
+
+def _split_book_names(book_raw: str) -> List[str]:
+    """切分多本書名（逗號、頓號、分號、換行）
+
+    分隔符含全形字元，str.translate 走不到 ASCII 快速路徑，實測比預先編譯的 split 慢，故維持正規表示式
+    """
+    return [x.strip() for x in _RE_BOOK_SPLIT.split(book_raw) if x.strip()]
+
+def _digits_only(s: str) -> str:
+    """只保留數字（與 \\D 相同的判定；已是純數字時直接回傳，省去正規表示式）"""
+    if s.isdecimal():
+        return s
+    return "".join(filter(str.isdecimal, s))
+
 def normalize_phone(s: str) -> Optional[str]:
     """正規化電話號碼（放寬規則：09 開頭 + 10 位數）"""
-    digits = re.sub(r"\D+", "", s or "")
+    digits = _digits_only(s or "")
     # 檢查：第一碼是 0，第二碼是 9，總共 10 位數
     if len(digits) == 10 and digits[0] == "0" and digits[1] == "9":
         return digits
     return None
 
+# 欄位名稱正規化（支援多種寫法）：標準欄位 -> 可接受的寫法，越前面優先
+_KV_FIELD_ALIASES = {
+    "姓名": ("姓名", "學員姓名", "name", "Name"),
+    "電話": ("電話", "學員電話", "phone", "Phone", "手機"),
+    "寄送地址": ("寄送地址", "地址", "address", "Address"),
+    "書籍名稱": ("書籍名稱", "書名", "book", "Book", "書籍"),
+    "業務備註": ("業務備註", "備註", "note", "Note"),
+}
+# 寫法 -> (標準欄位, 優先序)，解析時每個 key 只查一次表
+_KV_KEY_TABLE = {
+    alias: (field, rank)
+    for field, aliases in _KV_FIELD_ALIASES.items()
+    for rank, alias in enumerate(aliases)
+}
+
 def parse_kv_lines(text: str) -> Dict[str, str]:
     """解析 key:value 格式文字，支援多種欄位名稱"""
-    data = {}
+    # 單次掃描：每行只 partition 一次（全形冒號優先），直接對應標準欄位
+    # 同一欄位出現多種寫法時取優先序較前者；同一寫法重複出現時以後者為準
+    normalized = {}
+    best_rank = {}
     for line in text.strip().split("\n"):
-        line = line.strip()
-        if not line:
+        k, sep, v = line.partition("：")
+        if not sep:
+            k, sep, v = line.partition(":")
+            if not sep:
+                continue
+        hit = _KV_KEY_TABLE.get(k.strip())
+        if hit is None:
             continue
-        if "：" in line:
-            k, v = line.split("：", 1)
-            data[k.strip()] = v.strip()
-        elif ":" in line:
-            k, v = line.split(":", 1)
-            data[k.strip()] = v.strip()
-    
-    # 欄位名稱正規化（支援多種寫法）
-    normalized = {}
-    
-    # 姓名欄位
-    for key in ["姓名", "學員姓名", "name", "Name"]:
-        if key in data:
-            normalized["姓名"] = data[key]
-            break
-    
-    # 電話欄位
-    for key in ["電話", "學員電話", "phone", "Phone", "手機"]:
-        if key in data:
-            normalized["電話"] = data[key]
-            break
-    
-    # 地址欄位
-    for key in ["寄送地址", "地址", "address", "Address"]:
-        if key in data:
-            normalized["寄送地址"] = data[key]
-            break
-    
-    # 書籍欄位
-    for key in ["書籍名稱", "書名", "book", "Book", "書籍"]:
-        if key in data:
-            normalized["書籍名稱"] = data[key]
-            break
-    
-    # 備註欄位
-    for key in ["業務備註", "備註", "note", "Note"]:
-        if key in data:
-            normalized["業務備註"] = data[key]
-            break
+        field, rank = hit
+        if rank <= best_rank.get(field, rank):
+            normalized[field] = v.strip()
+            best_rank[field] = rank
     
     return normalized
 
 # ============================================
 # 書目主檔快取（修復 M1：優化讀取效能）
 # ============================================
-_BOOK_CACHE = {"ts": 0.0, "books": []}
+# 書目索引：books 書目清單、choices/owners 相似度比對字串與對應書名、name_map/alias_map 精確比對雜湊表
+# 每次重新載入都建立新的索引 dict 整個替換，查詢端取一次即拿到一致的快照
+_BOOK_CACHE = {"ts": 0.0, "index": {"books": [], "choices": [], "owners": [], "name_map": {}, "alias_map": {}}}
 _BOOK_CACHE_TTL = 600  # 10 分鐘
+_BOOK_LOCK = threading.Lock()
+
+def _split_fuzzy_aliases(fuzzy_normalized: str) -> List[str]:
+    """切分模糊比對欄位（先用逗號切分，再用空格切分）"""
+    names = []
+    for part in fuzzy_normalized.split(','):
+        names.extend([x.strip() for x in part.split() if x.strip()])
+    return names
+
+def _build_book_entry(name: str, lang: str, fuzzy: str, stock: Any) -> Dict[str, Any]:
+    """建立書目資料（載入時先算好正規化字串，查詢時不必逐本重算）"""
+    norm_name = _normalize_text_for_search(name).lower()
+    norm_lang = _normalize_text_for_search(lang).lower()
+    norm_fuzzy = _normalize_text_for_search(fuzzy).lower()
+    return {
+        "name": name,
+        "lang": lang,
+        "fuzzy": fuzzy,
+        "stock": stock,
+        "norm_name": norm_name,
+        "norm_aliases": _split_fuzzy_aliases(norm_fuzzy),
+        "norm_match": f"{norm_name} {norm_fuzzy}",  # 書名 + 模糊欄位
+        "norm_search": f"{norm_name} {norm_lang} {norm_fuzzy}",  # 再加語別
+    }
 
-def _load_books(force: bool = False) -> List[Dict[str, Any]]:
-    """載入書目主檔（含快取機制，修復 M1）"""
+def _load_book_index(force: bool = False) -> Dict[str, Any]:
+    """載入書目主檔並建立索引（含快取機制，修復 M1）"""
     now = time.time()
-    if (not force) and _BOOK_CACHE["books"] and (now - _BOOK_CACHE["ts"] < _BOOK_CACHE_TTL):
-        return _BOOK_CACHE["books"]
+    index = _BOOK_CACHE["index"]
+    if (not force) and index["books"] and (now - _BOOK_CACHE["ts"] < _BOOK_CACHE_TTL):
+        return index
     
-    try:
-        ws = _ws(BOOK_MASTER_SHEET_NAME)
-        rows = ws.get_all_records()
-        books = []
-        for r in rows:
-            if str(r.get("是否啟用", "")).strip() == "使用中":
-                name = str(r.get("書籍名稱", "")).strip()
-                lang = str(r.get("語別", "")).strip()
-                fuzzy = str(r.get("模糊比對書名", "")).strip()
-                stock = r.get("現有庫存", 0)
-                if name:
-                    books.append({
-                        "name": name,
-                        "lang": lang,
-                        "fuzzy": fuzzy,
-                        "stock": stock
-                    })
-        _BOOK_CACHE["books"] = books
-        _BOOK_CACHE["ts"] = now
-        app.logger.info(f"[BOOK] 已載入 {len(books)} 本書籍")
-        return books
-    except Exception as e:
-        app.logger.error(f"[BOOK] 載入失敗: {e}")
-        return _BOOK_CACHE["books"]  # 回傳舊快取
+    with _BOOK_LOCK:
+        # 取得鎖後再檢查一次，避免多個執行緒同時重新載入
+        now = time.time()
+        index = _BOOK_CACHE["index"]
+        if (not force) and index["books"] and (now - _BOOK_CACHE["ts"] < _BOOK_CACHE_TTL):
+            return index
+
+        try:
+            ws = _ws(BOOK_MASTER_SHEET_NAME)
+            if force:
+                _invalidate_sheet_cache(ws.title)
+            rows = _records_from_values(_cached_values(ws, ttl=_BOOK_CACHE_TTL))
+            books = []
+            for r in rows:
+                if str(r.get("是否啟用", "")).strip() == "使用中":
+                    name = str(r.get("書籍名稱", "")).strip()
+                    lang = str(r.get("語別", "")).strip()
+                    fuzzy = str(r.get("模糊比對書名", "")).strip()
+                    stock = r.get("現有庫存", 0)
+                    if name:
+                        books.append(_build_book_entry(name, lang, fuzzy, stock))
+            # 相似度比對用的字串清單（書名 + 各模糊名稱），owners 為對應的正式書名
+            choices, owners = [], []
+            # 精確比對用的雜湊表（同名時以主檔中先出現者為準）
+            name_map, alias_map = {}, {}
+            for book in books:
+                name_map.setdefault(book["norm_name"], book["name"])
+                for alias in book["norm_aliases"]:
+                    alias_map.setdefault(alias, book["name"])
+                for s in [book["norm_name"]] + book["norm_aliases"]:
+                    choices.append(s)
+                    owners.append(book["name"])
+            index = {
+                "books": books, "choices": choices, "owners": owners,
+                "name_map": name_map, "alias_map": alias_map,
+            }
+            _BOOK_CACHE.update({"ts": now, "index": index})
+            app.logger.info(f"[BOOK] 已載入 {len(books)} 本書籍")
+            return index
+        except Exception as e:
+            app.logger.error(f"[BOOK] 載入失敗: {e}")
+            return index  # 回傳舊快取
+
+def _load_books(force: bool = False) -> List[Dict[str, Any]]:
+    """載入書目主檔（含快取機制，修復 M1）"""
+    return _load_book_index(force)["books"]
 
 def _search_books_by_keyword(keyword: str) -> List[Dict[str, Any]]:
     """根據關鍵字搜尋書籍（處理全形/半形差異）"""
@@ -443,8 +944,7 @@ def _search_books_by_keyword(keyword: str) -> List[Dict[str, Any]]:
     
     for book in books:
         # 搜尋書名、語別、模糊比對欄位
-        search_text = _normalize_text_for_search(f"{book['name']} {book['lang']} {book['fuzzy']}").lower()
-        if keyword_normalized in search_text:
+        if keyword_normalized in book["norm_search"]:
             results.append(book)
     
     app.logger.info(f"[BOOK] 搜尋「{keyword}」找到 {len(results)} 本")
@@ -452,37 +952,22 @@ def _search_books_by_keyword(keyword: str) -> List[Dict[str, Any]]:
 
 def _find_book_exact(name: str) -> Optional[str]:
     """精確查找書名（處理全形/半形差異）"""
-    books = _load_books()
+    index = _load_book_index()
     name_normalized = _normalize_text_for_search(name).lower().strip()
     
-    # 1. 精確比對書名
-    for book in books:
-        book_name_normalized = _normalize_text_for_search(book["name"]).lower()
-        if book_name_normalized == name_normalized:
-            return book["name"]
-    
-    # 2. 模糊比對欄位（支援逗號和空格分隔）
-    for book in books:
-        fuzzy_normalized = _normalize_text_for_search(book["fuzzy"]).lower()
-        # 先用逗號切分，再用空格切分
-        fuzzy_names = []
-        for part in fuzzy_normalized.split(','):
-            fuzzy_names.extend([x.strip() for x in part.split() if x.strip()])
-        if name_normalized in fuzzy_names:
-            return book["name"]
-    
-    return None
+    # 1. 精確比對書名，2. 模糊比對欄位（支援逗號和空格分隔）
+    return index["name_map"].get(name_normalized) or index["alias_map"].get(name_normalized)
 
 def _suggest_books(wrong_name: str, max_results: int = MAX_BOOK_SUGGESTIONS) -> List[str]:
     """根據錯誤書名建議選項（優先關鍵字搜尋，處理全形/半形）"""
-    books = _load_books()
+    index = _load_book_index()
+    books = index["books"]
     wrong_normalized = _normalize_text_for_search(wrong_name).lower().strip()
     
     # 策略 1：關鍵字搜尋（搜尋書名和模糊欄位）
     keyword_matches = []
     for book in books:
-        search_text = _normalize_text_for_search(f"{book['name']} {book['fuzzy']}").lower()
-        if wrong_normalized in search_text:
+        if wrong_normalized in book["norm_match"]:
             keyword_matches.append(book["name"])
     
     if keyword_matches:
@@ -490,36 +975,27 @@ def _suggest_books(wrong_name: str, max_results: int = MAX_BOOK_SUGGESTIONS) ->
         return keyword_matches[:max_results]
     
     # 策略 2：模糊比對欄位精確匹配（支援逗號和空格分隔）
-    for book in books:
-        fuzzy_normalized = _normalize_text_for_search(book["fuzzy"]).lower()
-        # 先用逗號切分，再用空格切分
-        fuzzy_names = []
-        for part in fuzzy_normalized.split(','):
-            fuzzy_names.extend([x.strip() for x in part.split() if x.strip()])
-        if wrong_normalized in fuzzy_names:
-            app.logger.info(f"[BOOK] 模糊欄位精確匹配「{wrong_name}」→ {book['name']}")
-            return [book["name"]]
-    
-    # 策略 3：相似度比對（difflib）
-    candidates = []
-    for book in books:
-        # 比對書名
-        book_name_normalized = _normalize_text_for_search(book["name"]).lower()
-        ratio = difflib.SequenceMatcher(None, wrong_normalized, book_name_normalized).ratio()
-        candidates.append((ratio, book["name"]))
-        
-        # 比對模糊欄位（支援逗號和空格分隔）
-        fuzzy_normalized = _normalize_text_for_search(book["fuzzy"]).lower()
-        fuzzy_names = []
-        for part in fuzzy_normalized.split(','):
-            fuzzy_names.extend([x.strip() for x in part.split() if x.strip()])
-        for fuzzy in fuzzy_names:
-            if fuzzy.strip():
-                ratio2 = difflib.SequenceMatcher(None, wrong_normalized, fuzzy.strip()).ratio()
-                candidates.append((ratio2, book["name"]))
-    
-    # 排序並去重
-    candidates = sorted(set(candidates), key=lambda x: x[0], reverse=True)
+    alias_hit = index["alias_map"].get(wrong_normalized)
+    if alias_hit:
+        app.logger.info(f"[BOOK] 模糊欄位精確匹配「{wrong_name}」→ {alias_hit}")
+        return [alias_hit]
+    
+    # 策略 3：相似度比對（書名與模糊欄位，分數一律以 difflib 計算）
+    # RapidFuzz 的 Indel 相似度一定 ≥ SequenceMatcher.ratio，先用它篩掉不可能達門檻的選項，
+    # 剩下的再用 difflib 依原順序計分，FUZZY_THRESHOLD 與排序維持 difflib 的意義
+    choices, owners = index["choices"], index["owners"]
+    matches = rf_process.extract(
+        wrong_normalized, choices,
+        scorer=rf_fuzz.ratio, score_cutoff=FUZZY_THRESHOLD * 100 - 1e-6, limit=None  # 留浮點誤差，只多不少
+    )
+    indices = sorted(idx for _, _, idx in matches)
+    candidates = [
+        (difflib.SequenceMatcher(None, wrong_normalized, choices[i]).ratio(), owners[i])
+        for i in indices
+    ]
+    
+    # 排序
+    candidates.sort(key=lambda x: x[0], reverse=True)
     results = [name for score, name in candidates if score >= FUZZY_THRESHOLD]
     
     # 去重並限制數量
@@ -542,6 +1018,10 @@ def _suggest_books(wrong_name: str, max_results: int = MAX_BOOK_SUGGESTIONS) ->
 # ============================================
 # 郵遞區號查詢（修復 H2）
 # ============================================
+_ZIPREF_CACHE_TTL = 3600  # 參照表幾乎不變動，1 小時
+_ZIP_INDEX = {"src": None, "version": 0, "trie": {}}  # trie: 正規化區域逐字建立的字典樹，"" 鍵存 (郵遞區號, 區域名稱, 原順序)
+
+@functools.lru_cache(maxsize=4096)
 def _normalize_text_for_search(text: str) -> str:
     """正規化文字用於搜尋（處理全形/半形差異）"""
     if not text:
@@ -588,51 +1068,85 @@ def _normalize_address_for_compare(text: str) -> str:
     # 統一將「臺」轉換為「台」進行比對
     return text.replace("臺", "台").replace("台", "台")
 
+def _load_zip_index() -> int:
+    """載入郵遞區號參照表並建立比對清單，回傳版本號（參照表重新讀取時 +1）"""
+    ws = _ws(ZIPREF_SHEET_NAME)
+    values = _cached_values(ws, ttl=_ZIPREF_CACHE_TTL)
+    if _ZIP_INDEX["src"] is values:
+        return _ZIP_INDEX["version"]
+    
+    pairs = []
+    for row in _records_from_values(values):
+        # 支援兩種格式：
+        # 格式1: 只有「區域」欄位（例：台南市北區）
+        # 格式2: 分別有「縣市」和「區域」欄位
+        
+        city = str(row.get("縣市", "")).strip()
+        district = str(row.get("區域", "")).strip()
+        zip_code = str(row.get("郵遞區號", "")).strip()
+        
+        if not zip_code:
+            continue
+        
+        # 建構完整區域名稱
+        if city and district:
+            # 格式2: 縣市 + 區域
+            full_district = f"{city}{district}"
+        elif district:
+            # 格式1: 只有區域
+            full_district = district
+        else:
+            continue
+        
+        pairs.append((_normalize_address_for_compare(full_district), zip_code, full_district))
+    
+    # 建立字典樹；同一區域重複時保留參照表中先出現者
+    trie: Dict[str, Any] = {}
+    for order, (district_normalized, zip_code, full_district) in enumerate(pairs):
+        if not district_normalized:
+            continue
+        node = trie
+        for ch in district_normalized:
+            node = node.setdefault(ch, {})
+        node.setdefault("", (zip_code, full_district, order))
+    _ZIP_INDEX.update({"src": values, "version": _ZIP_INDEX["version"] + 1, "trie": trie})
+    return _ZIP_INDEX["version"]
+
+@functools.lru_cache(maxsize=2048)
+def _match_zip(address_normalized: str, version: int) -> Optional[Tuple[str, str]]:
+    """在字典樹中找最長匹配的區域（version 讓參照表更新後舊結果自動失效）
+
+    從地址每個位置沿字典樹往下走，成本只與地址長度相關；取最長者，同長取參照表較前者
+    """
+    trie = _ZIP_INDEX["trie"]
+    best = None
+    best_key = (0, 0)
+    n = len(address_normalized)
+    for i in range(n):
+        node = trie
+        for j in range(i, n):
+            node = node.get(address_normalized[j])
+            if node is None:
+                break
+            hit = node.get("")
+            if hit:
+                key = (j - i + 1, -hit[2])
+                if best is None or key > best_key:
+                    best, best_key = hit, key
+    return (best[0], best[1]) if best else None
+
 def _find_zip_code(address: str) -> Optional[str]:
     """查詢郵遞區號（支援縣市+區域匹配，最長匹配優先）"""
     try:
-        ws = _ws(ZIPREF_SHEET_NAME)
-        rows = ws.get_all_records()
+        version = _load_zip_index()
         
         # 正規化地址
         address_normalized = _normalize_address_for_compare(address)
         
-        # 收集所有匹配的區域，並按長度排序（最長優先）
-        matches = []
-        for row in rows:
-            # 支援兩種格式：
-            # 格式1: 只有「區域」欄位（例：台南市北區）
-            # 格式2: 分別有「縣市」和「區域」欄位
-            
-            city = str(row.get("縣市", "")).strip()
-            district = str(row.get("區域", "")).strip()
-            zip_code = str(row.get("郵遞區號", "")).strip()
-            
-            if not zip_code:
-                continue
-            
-            # 建構完整區域名稱
-            if city and district:
-                # 格式2: 縣市 + 區域
-                full_district = f"{city}{district}"
-            elif district:
-                # 格式1: 只有區域
-                full_district = district
-            else:
-                continue
-            
-            # 正規化並比對
-            full_district_normalized = _normalize_address_for_compare(full_district)
-            
-            if full_district_normalized in address_normalized:
-                matches.append((len(full_district_normalized), zip_code, full_district))
-        
-        if matches:
-            # 按匹配長度降序排序，取最長的
-            matches.sort(key=lambda x: x[0], reverse=True)
-            best_match = matches[0]
-            app.logger.info(f"[ZIP] 找到郵遞區號 {best_match[1]} for {best_match[2]} (原地址: {address})")
-            return best_match[1]
+        best_match = _match_zip(address_normalized, version)
+        if best_match:
+            app.logger.info(f"[ZIP] 找到郵遞區號 {best_match[0]} for {best_match[1]} (原地址: {address})")
+            return best_match[0]
         
         app.logger.warning(f"[ZIP] 找不到郵遞區號: {address}")
         return None
@@ -644,30 +1158,46 @@ def _find_zip_code(address: str) -> Optional[str]:
 # OCR 會話管理
 # ============================================
 def _start_ocr_session(user_id: str):
-    """開啟 OCR 會話"""
-    expire = time.time() + (OCR_SESSION_TTL_MIN * 60)
-    _OCR_SESSIONS[user_id] = expire
+    """開啟 OCR 會話（順便清掉已過期的會話）"""
+    now = time.time()
+    with _OCR_LOCK:
+        for uid in [u for u, exp in _OCR_SESSIONS.items() if now > exp]:
+            del _OCR_SESSIONS[uid]
+        _OCR_SESSIONS[user_id] = now + (OCR_SESSION_TTL_MIN * 60)
     app.logger.info(f"[OCR] 開啟會話: {user_id}")
 
-def _has_ocr_session(user_id: str) -> bool:
-    """檢查是否有有效的 OCR 會話"""
-    if user_id not in _OCR_SESSIONS:
-        return False
-    if time.time() > _OCR_SESSIONS[user_id]:
-        _OCR_SESSIONS.pop(user_id, None)
+def _take_ocr_session(user_id: str) -> bool:
+    """取用 OCR 會話：有效則關閉並回傳 True（檢查與關閉在同一把鎖內完成）"""
+    with _OCR_LOCK:
+        expire = _OCR_SESSIONS.pop(user_id, None)
+    if expire is None or time.time() > expire:
         return False
+    app.logger.info(f"[OCR] 關閉會話: {user_id}")
     return True
 
-def _clear_ocr_session(user_id: str):
-    """清除 OCR 會話"""
-    _OCR_SESSIONS.pop(user_id, None)
-    app.logger.info(f"[OCR] 關閉會話: {user_id}")
+_IMAGE_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))  # Vision 單張圖片上限內
 
 def _download_line_image_bytes(message_id: str) -> bytes:
-    """下載 LINE 圖片"""
+    """下載 LINE 圖片（以 64KB 區塊串流寫入緩衝區，避免預設 1KB 小區塊累積成大量片段）
+
+    超過 MAX_IMAGE_BYTES 直接中止，不把整張大圖讀進記憶體
+    """
     try:
         content = line_bot_api.get_message_content(message_id)
-        return b"".join(content.iter_content())
+        try:
+            size = content.response.headers.get("Content-Length")
+            if size and size.isdigit() and int(size) > MAX_IMAGE_BYTES:
+                raise ValueError(f"圖片過大（{int(size) // 1024} KB），請壓縮後再上傳")
+            buf = io.BytesIO()
+            for chunk in content.iter_content(chunk_size=_IMAGE_CHUNK_SIZE):
+                buf.write(chunk)
+                if buf.tell() > MAX_IMAGE_BYTES:
+                    raise ValueError(f"圖片過大（超過 {MAX_IMAGE_BYTES // 1024} KB），請壓縮後再上傳")
+            return buf.getvalue()
+        finally:
+            # 提前中止時串流尚未讀完，要關閉 requests.Response 才會釋放連線池的連線
+            content.response.response.close()
     except Exception as e:
         app.logger.error(f"[OCR] 下載圖片失敗: {e}")
         raise
@@ -680,11 +1210,17 @@ def _ocr_text_from_bytes(img_bytes: bytes) -> str:
     try:
         from google.cloud import vision
         image = vision.Image(content=img_bytes)
-        response = _vision_client.text_detection(image=image)
+        # 出貨單屬密集文字，document_text_detection 的版面分析比 text_detection 準確；
+        # 指定語言（繁中 + 英數）縮小辨識範圍
+        response = _vision_client.document_text_detection(
+            image=image, image_context={"language_hints": OCR_LANGUAGE_HINTS}
+        )
         
         if response.error.message:
             raise RuntimeError(f"Vision API 錯誤: {response.error.message}")
         
+        if response.full_text_annotation.text:
+            return response.full_text_annotation.text
         texts = response.text_annotations
         if texts:
             return texts[0].description
@@ -698,18 +1234,17 @@ def _ocr_text_from_bytes(img_bytes: bytes) -> str:
 # ============================================
 def _pair_ids_with_numbers(text: str) -> Tuple[List[Tuple[str, str]], List[str]]:
     """配對寄書ID與12碼單號"""
-    lines = [ln.strip() for ln in text.split("\n") if ln.strip()]
-    
-    rid_pattern = re.compile(r"R\d{4}", re.IGNORECASE)
-    num_pattern = re.compile(r"\d{12}")
-    
     rids = []
     nums = []
     leftovers = []
     
-    for line in lines:
-        r_match = rid_pattern.search(line)
-        n_match = num_pattern.search(line)
+    # 每行只 strip 一次；每行只取第一個 ID / 單號，所以仍逐行比對而非整段 finditer
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        r_match = _RE_RID.search(line)
+        n_match = _RE_NUM12.search(line)
         
         if r_match:
             rids.append(r_match.group(0).upper())
@@ -722,46 +1257,74 @@ def _pair_ids_with_numbers(text: str) -> Tuple[List[Tuple[str, str]], List[str]]
     pairs = list(zip(rids, nums))
     return pairs, leftovers
 
+def _ocr_range_update(rows: List[int], col_ids: List[int], row_values: Dict[int, list]) -> Dict[str, Any]:
+    """連續列 × 相鄰欄組成單一範圍的批次更新項目"""
+    return {
+        "range": f"{rowcol_to_a1(rows[0], col_ids[0])}:{rowcol_to_a1(rows[-1], col_ids[-1])}",
+        "values": [[value for _, value in row_values[row_i]] for row_i in rows],
+    }
+
 def _write_ocr_results(pairs: List[Tuple[str, str]], event) -> str:
     """寫入 OCR 結果"""
-    try:
-        uid = getattr(event.source, "user_id", "")
-        profile = line_bot_api.get_profile(uid)
-        operator = profile.display_name or "系統"
-    except Exception:
-        operator = "系統"
+    operator = _display_name(getattr(event.source, "user_id", ""))
     
     try:
         ws = _ws(MAIN_SHEET_NAME)
         h = _get_header_map(ws)
-        all_vals = ws.get_all_values()
+        cols = _main_cols(h)
         
         # 支援多種表頭名稱
-        idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-        idx_tracking = _col_idx(h, "託運單號", _col_idx(h, "已託運-12碼單號", 11))
-        idx_date = _col_idx(h, "寄出日期", _col_idx(h, "已託運-寄出日期", 10))
-        idx_person = _col_idx(h, "經手人", _col_idx(h, "已託運-經手人", 12))
-        idx_status = _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
+        idx_rid = cols["rid"]
+        idx_tracking = cols["tracking"]
+        idx_date = cols["ship_date"]
+        idx_person = cols["person"]
+        idx_status = cols["status"]
         
-        success_count = 0
+        written = set()  # 已更新的寄書ID（同一張單重複出現只算一次）
         not_found = []
+        row_values = {}  # 列號 -> 依欄位排序的值
         
-        for rid, tracking_num in pairs:
-            found_row = None
-            for i, r in enumerate(all_vals[1:], start=2):
-                if len(r) >= idx_rid and r[idx_rid - 1] == rid:
-                    found_row = i
-                    break
+        # 定位列號到寫入完成之間持有寫入鎖，期間其他執行緒插入新訂單不會讓列號位移
+        with _sheet_write_lock(ws.title):
+            # 寄書ID -> 列號，每組配對直接查表（同 ID 多列時取第一列）；只需讀取 ID 欄
+            rid_rows = _rid_row_index(_cached_columns(ws, (idx_rid,), ttl=ROW_LOOKUP_TTL), 1)
+            today = today_str()
+        
+            for rid, tracking_num in pairs:
+                found_row = rid_rows.get(rid, [None])[0]
             
-            if found_row:
-                _safe_update_cell(ws, found_row, idx_tracking, tracking_num)
-                _safe_update_cell(ws, found_row, idx_date, today_str())
-                _safe_update_cell(ws, found_row, idx_person, operator)
-                _safe_update_cell(ws, found_row, idx_status, "已託運")
-                success_count += 1
-                app.logger.info(f"[OCR] 更新 {rid} -> {tracking_num}")
+                if found_row:
+                    cells = sorted({
+                        idx_tracking: tracking_num,
+                        idx_date: today,
+                        idx_person: operator,
+                        idx_status: "已託運",
+                    }.items())
+                    row_values[found_row] = cells
+                    written.add(rid)
+                else:
+                    not_found.append(rid)
+        
+            updates = []
+            col_ids = sorted({idx_tracking, idx_date, idx_person, idx_status})
+            if col_ids[-1] - col_ids[0] == len(col_ids) - 1:
+                # 欄位相鄰（預設 J..M）：連續列合併成一個範圍，例如 J5:M8
+                run = []
+                for row_i in sorted(row_values):
+                    if run and row_i != run[-1] + 1:
+                        updates.append(_ocr_range_update(run, col_ids, row_values))
+                        run = []
+                    run.append(row_i)
+                if run:
+                    updates.append(_ocr_range_update(run, col_ids, row_values))
             else:
-                not_found.append(rid)
+                for row_i, cells in row_values.items():
+                    for col, value in cells:
+                        updates.append({"range": rowcol_to_a1(row_i, col), "values": [[value]]})
+        
+            _safe_batch_update(ws, updates)
+        success_count = len(written)
+        app.logger.info(f"[OCR] 更新 {success_count} 筆，找不到 {len(not_found)} 筆")
         
         msg = f"✅ 已更新 {success_count} 筆出貨單"
         if not_found:
@@ -819,7 +1382,7 @@ def _validate_order_data(data: Dict[str, str]) -> Dict[str, List[str]]:
     if not book_raw:
         errors["books"].append("書籍名稱為必填")
     else:
-        book_names = [x.strip() for x in re.split(r"[,，、;；\n]+", book_raw) if x.strip()]
+        book_names = _split_book_names(book_raw)
         invalid_books = []
         
         for book_name in book_names:
@@ -882,11 +1445,11 @@ def _start_book_selection(event, validation_data: Dict, invalid_books: List[str]
         msg = "❌ 找不到以下書籍：\n"
         msg += "\n".join([f"• {b['wrong']}" for b in books_with_suggestions])
         msg += "\n\n請使用「#查書名」確認正確書名"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        _reply(event, msg)
         return
     
     # 儲存選書狀態（加入超時機制）
-    _PENDING[user_id] = {
+    _set_pending(user_id, {
         "type": "book_selection_step",
         "expire_at": time.time() + 300,  # 5分鐘超時
         "validation_data": validation_data,
@@ -894,7 +1457,7 @@ def _start_book_selection(event, validation_data: Dict, invalid_books: List[str]
         "all_books": books_with_suggestions,
         "current_index": 0,
         "selected_books": []
-    }
+    })
     
     # 顯示第一本書的選單
     _show_book_selection_prompt(event, current_book, 1, len(books_with_suggestions))
@@ -911,7 +1474,7 @@ def _show_book_selection_prompt(event, book_info: Dict, current: int, total: int
     lines.append("\n請回覆數字選擇，或回覆「取消」結束")
     
     msg = "\n".join(lines)
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    _reply(event, msg)
 
 def _handle_book_selection_step(event, text: str) -> bool:
     """處理逐本選書流程（新函式）"""
@@ -923,16 +1486,16 @@ def _handle_book_selection_step(event, text: str) -> bool:
     
     # 檢查超時
     if time.time() > pend.get("expire_at", 0):
-        _PENDING.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⏱️ 選書流程已超時，請重新輸入 #寄書"))
+        _drop_pending(user_id)
+        _reply(event, "⏱️ 選書流程已超時，請重新輸入 #寄書")
         return True
     
     ans = text.strip().upper()
     
     # 取消
     if ans in ("取消", "CANCEL", "N"):
-        _PENDING.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消選書流程"))
+        _drop_pending(user_id)
+        _reply(event, "已取消選書流程")
         return True
     
     # 檢查是否為數字
@@ -946,7 +1509,7 @@ def _handle_book_selection_step(event, text: str) -> bool:
     
     # 檢查選擇是否有效
     if choice < 1 or choice > len(current_book["suggestions"]):
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 無效的選項，請選擇 1-{len(current_book['suggestions'])}"))
+        _reply(event, f"❌ 無效的選項，請選擇 1-{len(current_book['suggestions'])}")
         return True
     
     # 記錄選擇
@@ -976,7 +1539,7 @@ def _handle_book_selection_step(event, text: str) -> bool:
         biz_note = pend["biz_note"]
         
         # 組合最終書名（包含已選擇的和原本正確的）
-        original_books = [x.strip() for x in re.split(r"[,，、;；\n]+", validation_data["book"]) if x.strip()]
+        original_books = _split_book_names(validation_data["book"])
         final_books = []
         
         selected_index = 0
@@ -991,9 +1554,12 @@ def _handle_book_selection_step(event, text: str) -> bool:
         
         final_book_str = "、".join(final_books)
         
-        _PENDING.pop(user_id, None)
-        _create_order_confirmed(
+        # 先認領再建單（寫入交給背景執行緒，重複送出的最後一個選項直接忽略）
+        if not _claim_pending(user_id, pend):
+            return True
+        _defer(
             event,
+            _create_order_confirmed,
             validation_data["name"],
             validation_data["phone"],
             validation_data["address"],
@@ -1061,12 +1627,13 @@ def _handle_new_order(event, text: str):
     """處理新寄書（含驗證，支援逐本確認）"""
     user_id = event.source.user_id
     
-    # 檢查是否有未完成的流程
-    if user_id in _PENDING:
-        pend_type = _PENDING[user_id].get("type", "")
+    # 檢查是否有未完成的流程（在背景執行緒執行，待確認資料可能同時被移除，只讀一次）
+    pend = _PENDING.get(user_id)
+    if pend:
+        pend_type = pend.get("type", "")
         if pend_type == "book_selection_step":
             msg = "⚠️ 您有未完成的選書流程\n\n回覆「取消」可清除，或繼續完成選書"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+            _reply(event, msg)
             return
     
     lines_after = text.replace("#寄書", "").strip()
@@ -1091,7 +1658,7 @@ def _handle_new_order(event, text: str):
     # 如果有姓名、電話、地址錯誤，直接提示
     if "name" in errors or "phone" in errors or "address" in errors:
         error_msg = _format_validation_errors_simple(errors)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=error_msg))
+        _reply(event, error_msg)
         return
     
     # 如果有書籍錯誤，啟動逐本確認流程
@@ -1103,14 +1670,46 @@ def _handle_new_order(event, text: str):
     # 無錯誤，直接建立訂單
     _create_order_confirmed(event, name, phone_raw, address_raw, book_raw, biz_note)
 
-def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str, book_raw: str, biz_note: str):
-    """確認無誤後建立訂單（根據實際表頭動態寫入）"""
+# 寄書ID 計數器：記住目前最大編號，不必每張訂單都讀整欄
+# 定期（RID_COUNTER_TTL 秒）重新讀一次 ID 欄，納入在試算表上手動新增的紀錄
+RID_COUNTER_TTL = int(os.getenv("RID_COUNTER_TTL", "300"))
+_RID_STATE = {"ts": 0.0, "last": 0}
+_RID_LOCK = threading.Lock()
+
+def _max_rid_in_column(ws, idx_rid: int) -> int:
+    """讀取 ID 欄並回傳目前最大編號"""
     try:
-        uid = getattr(event.source, "user_id", "")
-        profile = line_bot_api.get_profile(uid)
-        operator = profile.display_name or "系統"
+        ids = ws.col_values(idx_rid)
     except Exception:
-        operator = "系統"
+        _forget_ws(ws)
+        raise
+    max_num = 0
+    for eid in islice(ids, 1, None):
+        m = _RE_RID_NUM.match(eid)
+        if m:
+            max_num = max(max_num, int(m.group(1)))
+    return max_num
+
+def _next_rid(ws, idx_rid: int) -> str:
+    """取得下一個寄書ID（同一把鎖內遞增，並行建單也不會拿到相同編號）"""
+    with _RID_LOCK:
+        now = time.time()
+        if now - _RID_STATE["ts"] >= RID_COUNTER_TTL:
+            seeded = _max_rid_in_column(ws, idx_rid)
+            app.logger.info(f"[ORDER] 重新讀取最大編號: {seeded}")
+            _RID_STATE["last"] = max(_RID_STATE["last"], seeded)
+            _RID_STATE["ts"] = now
+        _RID_STATE["last"] += 1
+        return f"R{_RID_STATE['last']:04d}"
+
+def _reset_rid_counter():
+    """下次取號時重新讀取 ID 欄（保留目前編號：並行建單可能已取得較大編號但尚未寫入）"""
+    with _RID_LOCK:
+        _RID_STATE["ts"] = 0.0
+
+def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str, book_raw: str, biz_note: str):
+    """確認無誤後建立訂單（根據實際表頭動態寫入）"""
+    operator = _display_name(getattr(event.source, "user_id", ""))
     
     app.logger.info(f"[ORDER] 開始建立訂單 - 姓名:{name}, 電話:{phone_raw}, 書籍:{book_raw}")
     
@@ -1125,7 +1724,7 @@ def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str,
     app.logger.info(f"[ORDER] 處理後 - 電話:{phone}, 郵遞區號:{zip_code}, 地址:{address}")
     
     # 解析書名
-    book_names = [x.strip() for x in re.split(r"[,，、;；\n]+", book_raw) if x.strip()]
+    book_names = _split_book_names(book_raw)
     final_books = []
     for book_name in book_names:
         matched = _find_book_exact(book_name)
@@ -1137,33 +1736,23 @@ def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str,
     app.logger.info(f"[ORDER] 解析書名完成: {final_books}")
     
     try:
-        app.logger.info(f"[ORDER] 準備寫入工作表: {MAIN_SHEET_NAME}")
+        app.logger.debug("[ORDER] 準備寫入工作表: %s", MAIN_SHEET_NAME)
         ws = _ws(MAIN_SHEET_NAME)
         h = _get_header_map(ws)
-        app.logger.info(f"[ORDER] 表頭對應: {h}")
-        
-        all_vals = ws.get_all_values()
-        header = all_vals[0] if all_vals else []
-        app.logger.info(f"[ORDER] 實際表頭: {header}")
-        app.logger.info(f"[ORDER] 目前資料列數: {len(all_vals)}")
+        app.logger.debug("[ORDER] 表頭對應: %s", h)
         
         # 生成新 ID
         # 支援多種 ID 欄位名稱
         idx_rid = _col_idx(h, "寄書ID", _col_idx(h, "紀錄ID", 1))
-        existing_ids = [r[idx_rid - 1] for r in all_vals[1:] if len(r) >= idx_rid and r[idx_rid - 1].startswith("R")]
-        max_num = 0
-        for eid in existing_ids:
-            m = re.match(r"R(\d+)", eid)
-            if m:
-                max_num = max(max_num, int(m.group(1)))
-        new_rid = f"R{max_num + 1:04d}"
+        new_rid = _next_rid(ws, idx_rid)
         
-        app.logger.info(f"[ORDER] 生成新ID: {new_rid} (目前最大編號: {max_num})")
+        app.logger.info(f"[ORDER] 生成新ID: {new_rid}")
         
         # 根據表頭欄位數量建立空白列
-        num_cols = len(header)
+        num_cols = max(h.values()) if h else 0
         
-        # 寫入多列
+        # 組出每本書一列，最後一次寫入
+        rows_to_insert = []
         for book in final_books:
             # 建立空白列（填滿所有欄位）
             row = [""] * num_cols
@@ -1235,9 +1824,16 @@ def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str,
             elif "狀態" in h:
                 row[h["狀態"] - 1] = "待處理"
             
-            app.logger.info(f"[ORDER] 準備寫入: {row[:5]}... (共 {len(row)} 欄)")
-            _safe_append_row(ws, row)
-            app.logger.info(f"[ORDER] ✅ 成功建立寄書 {new_rid}: {name} / {book}")
+            app.logger.debug("[ORDER] 準備寫入: %s... (共 %d 欄)", row[:5], len(row))
+            rows_to_insert.append(row)
+        
+        try:
+            _safe_insert_rows(ws, rows_to_insert)
+        except Exception:
+            # 寫入失敗時強制下次重新讀取 ID 欄（與記憶體中的編號取較大者，跳號不重號）
+            _reset_rid_counter()
+            raise
+        app.logger.info(f"[ORDER] ✅ 成功建立寄書 {new_rid}: {name} / {', '.join(final_books)}")
         
         msg_lines = ["✅ 寄書建立完成"]
         msg_lines.append(f"建單日期：{now_str_min()}")
@@ -1247,11 +1843,11 @@ def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str,
         msg_lines.append("狀態：待處理")
         
         msg = "\n".join(msg_lines)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        _reply(event, msg)
         app.logger.info(f"[ORDER] 訂單建立完成，已回覆使用者")
     except Exception as e:
         app.logger.error(f"[ORDER] ❌ 建立失敗: {e}", exc_info=True)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 建立失敗: {e}"))
+        _reply(event, f"❌ 建立失敗: {e}")
         raise
 
 # ============================================
@@ -1259,87 +1855,69 @@ def _create_order_confirmed(event, name: str, phone_raw: str, address_raw: str,
 # ============================================
 def _handle_query(event, text: str):
     """查詢寄書（支援多種表頭名稱）"""
-    query = text.replace("#查詢寄書", "").replace("#查寄書", "").strip()
+    query = _RE_QUERY_CMD.sub("", text.strip()).strip()
     
     if not query:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入查詢關鍵字（姓名或電話後9碼）"))
+        _reply(event, "請輸入查詢關鍵字（姓名或電話後9碼）")
         return
     
     try:
         ws = _ws(MAIN_SHEET_NAME)
         h = _get_header_map(ws)
-        all_vals = ws.get_all_values()
+        cols = _main_cols(h)
         
-        # 支援多種欄位名稱
-        idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-        idx_name = _col_idx(h, "學員姓名", _col_idx(h, "姓名", 4))
-        idx_phone = _col_idx(h, "學員電話", _col_idx(h, "電話", 5))
-        idx_book = _col_idx(h, "書籍名稱", 7)
-        idx_status = _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
-        
-        app.logger.info(f"[QUERY] 欄位索引 - ID:{idx_rid}, 姓名:{idx_name}, 電話:{idx_phone}, 書籍:{idx_book}, 狀態:{idx_status}")
+        # 支援多種欄位名稱；只讀取查詢需要的欄位（依序：ID、姓名、電話、書籍、狀態）
+        col_ids = (cols["rid"], cols["name"], cols["phone"], cols["book"], cols["status"])
+        app.logger.debug("[QUERY] 欄位索引 - ID:%d, 姓名:%d, 電話:%d, 書籍:%d, 狀態:%d", *col_ids)
+        all_vals = _cached_columns(ws, col_ids, ttl=ROW_LOOKUP_TTL)
         
         # 查詢邏輯
-        query_digits = re.sub(r"\D", "", query)
+        query_digits = _digits_only(query)
         matches = []
         
-        for i, r in enumerate(all_vals[1:], start=2):
-            if len(r) < max(idx_rid, idx_name, idx_phone, idx_book, idx_status):
-                continue
-            
-            name = r[idx_name - 1] if len(r) >= idx_name else ""
-            phone = r[idx_phone - 1] if len(r) >= idx_phone else ""
-            
-            # 姓名比對
-            if query in name:
-                matches.append((i, r))
-                continue
-            
-            # 電話後9碼比對
-            if query_digits and len(query_digits) >= PHONE_SUFFIX_MATCH:
-                phone_digits = re.sub(r"\D", "", phone)
-                if phone_digits.endswith(query_digits[-PHONE_SUFFIX_MATCH:]):
-                    matches.append((i, r))
-                    continue
+        # 電話後9碼比對：直接查索引取得命中列號
+        phone_hits = set()
+        if len(query_digits) >= PHONE_SUFFIX_MATCH:
+            phone_hits = set(_phone_suffix_index(all_vals, 3).get(query_digits[-PHONE_SUFFIX_MATCH:], []))
+        
+        for i, r in enumerate(islice(all_vals, 1, None), start=2):
+            # 姓名比對 / 電話比對
+            if query in r[1] or i in phone_hits:
+                matches.append(r)
         
         if not matches:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"查無資料：{query}"))
+            _reply(event, f"查無資料：{query}")
             return
         
         # 合併同 ID
         grouped = {}
-        for row_i, r in matches:
-            rid = r[idx_rid - 1] if len(r) >= idx_rid else ""
+        for rid, name, phone, book, status in matches:
             if rid not in grouped:
-                grouped[rid] = {
-                    "name": r[idx_name - 1] if len(r) >= idx_name else "",
-                    "phone": r[idx_phone - 1] if len(r) >= idx_phone else "",
-                    "status": r[idx_status - 1] if len(r) >= idx_status else "",
-                    "books": []
-                }
-            if len(r) >= idx_book:
-                grouped[rid]["books"].append(r[idx_book - 1])
+                grouped[rid] = {"name": name, "phone": phone, "status": status, "books": []}
+            grouped[rid]["books"].append(book)
         
         # 格式化輸出
         lines = [f"查詢結果（共 {len(grouped)} 筆）：\n"]
-        for rid, info in list(grouped.items())[:10]:  # 最多10筆
+        # 結果一律新的在前（附加在表尾時，表中順序是舊到新）
+        ordered = grouped.items() if INSERT_AT_TOP else reversed(grouped.items())
+        for rid, info in islice(ordered, 10):  # 最多10筆
             books_str = "、".join(info["books"])
             lines.append(f"{rid}: {info['name']}")
             lines.append(f"  電話: {info['phone']}")
             lines.append(f"  書籍: {books_str}")
             lines.append(f"  狀態: {info['status']}\n")
         
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="\n".join(lines)))
+        _reply(event, "\n".join(lines))
     except Exception as e:
         app.logger.error(f"[QUERY] 查詢失敗: {e}", exc_info=True)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 查詢失敗: {e}"))
+        _reply(event, f"❌ 查詢失敗: {e}")
 
 # ============================================
 # 取消/刪除寄書（支援 ID、姓名、電話）
 # ============================================
 def _extract_cancel_target(text: str):
     """從取消寄書指令中提取查詢條件（姓名、電話、或 ID）"""
-    body = re.sub(r"^#(取消寄書|刪除寄書)\s*", "", text.strip())
+    body = _RE_CANCEL_CMD.sub("", text.strip())
     
     # 如果直接是 R 開頭，視為 ID
     if body.startswith("R"):
@@ -1347,20 +1925,15 @@ def _extract_cancel_target(text: str):
     
     name, phone = None, None
     
-    # 嘗試解析 key:value 格式
+    # 嘗試解析 key:value 格式（parse_kv_lines 已將欄位名稱正規化）
     data = parse_kv_lines(body)
-    for k in list(data.keys()):
-        if any(x in k for x in ["姓名", "學員", "收件人", "名字", "貴姓"]):
-            name = data.pop(k)
-            break
-    for k in list(data.keys()):
-        if "電話" in k:
-            phone = normalize_phone(data.pop(k))
-            break
+    name = data.get("姓名")
+    if "電話" in data:
+        phone = normalize_phone(data["電話"])
     
     # 如果沒有 key:value，嘗試直接解析
     if not name and not phone:
-        tokens = re.split(r"\s+", body)
+        tokens = _RE_WHITESPACE.split(body)
         for t in tokens:
             tt = t.strip()
             if not tt:
@@ -1369,7 +1942,7 @@ def _extract_cancel_target(text: str):
             if (not phone) and p:
                 phone = p
                 continue
-            if not name and not re.search(r"\d", tt):
+            if not name and not _RE_HAS_DIGIT.search(tt):
                 name = tt
     
     if name or phone:
@@ -1379,110 +1952,79 @@ def _extract_cancel_target(text: str):
 
 def _find_latest_order(ws, name: str, phone: str):
     """根據姓名或電話查找最近一筆「待處理」的訂單"""
+    all_vals = _cached_values(ws, ttl=ROW_LOOKUP_TTL)
     h = _get_header_map(ws)
-    idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-    idx_date = _col_idx(h, "建單日期", 2)
-    idx_name = _col_idx(h, "學員姓名", _col_idx(h, "姓名", 4))
-    idx_phone = _col_idx(h, "學員電話", _col_idx(h, "電話", 5))
-    idx_status = _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
-    
-    all_vals = ws.get_all_values()
-    rows = all_vals[1:]
-    
-    # 電話後 N 碼比對
+    cols = _main_cols(h)
+    idx_rid = cols["rid"]
+    idx_date = cols["created"]
+    idx_name = cols["name"]
+    idx_phone = cols["phone"]
+    idx_status = cols["status"]
+    
+    # 電話後 N 碼比對：有電話時只看索引命中的列，不必掃整張表
     phone_suffix = None
     if phone:
-        pd = re.sub(r"\D+", "", phone)
+        pd = _digits_only(phone)
         if len(pd) >= PHONE_SUFFIX_MATCH:
             phone_suffix = pd[-PHONE_SUFFIX_MATCH:]
+    if phone_suffix:
+        scan = [(ridx, all_vals[ridx - 1]) for ridx in _phone_suffix_index(all_vals, idx_phone).get(phone_suffix, [])]
+    else:
+        scan = enumerate(islice(all_vals, 1, None), start=2)
     
+    # 欄位索引先轉成 0 起算的區域變數，迴圈內只做長度檢查，不需逐列 try/except
+    i_status, i_name, i_date = idx_status - 1, idx_name - 1, idx_date - 1
     candidates = []
-    for ridx, r in enumerate(rows, start=2):
-        try:
-            # 排除「已刪除」
-            status = (r[idx_status - 1] if len(r) >= idx_status else "").strip()
-            if status == "已刪除":
-                continue
-            
-            # 只查詢「待處理」
-            if status != "待處理":
-                continue
-            
-            # 姓名比對
-            if name:
-                row_name = (r[idx_name - 1] if len(r) >= idx_name else "")
-                if name not in row_name:
-                    continue
-            
-            # 電話比對
-            if phone_suffix:
-                row_phone = re.sub(r"\D+", "", r[idx_phone - 1] if len(r) >= idx_phone else "")
-                if not (len(row_phone) >= PHONE_SUFFIX_MATCH and row_phone[-PHONE_SUFFIX_MATCH:] == phone_suffix):
-                    continue
-            
-            # 解析建單時間
-            dt_str = (r[idx_date - 1] if len(r) >= idx_date else "").strip()
-            dt = None
-            if dt_str:
-                try:
-                    dt = datetime.strptime(dt_str[:16], "%Y-%m-%d %H:%M")
-                except Exception:
-                    dt = None
-            
-            key_dt = dt or datetime.min
-            candidates.append((key_dt, ridx, r))
-        except Exception:
+    for ridx, r in scan:
+        n = len(r)
+        # 只查詢「待處理」（「已刪除」等其他狀態一律排除）
+        if (r[i_status].strip() if n > i_status else "") != "待處理":
+            continue
+        
+        # 姓名比對
+        if name and name not in (r[i_name] if n > i_name else ""):
             continue
+        
+        # 解析建單時間
+        candidates.append((_dt_sort_key(r[i_date].strip() if n > i_date else ""), ridx, r))
     
     if not candidates:
         return (None, None)
     
-    # 取建單時間最新的一筆
-    candidates.sort(key=lambda x: x[0], reverse=True)
-    _, row_i, row = candidates[0]
+    # 取建單時間最新的一筆（同時間取表中較前者）
+    _, row_i, row = max(candidates, key=lambda x: x[0])
     return row_i, row
 
 def _collect_rows_by_rid(ws, rid: str):
     """回傳該 RID 的所有 (row_index, row_values)"""
+    all_vals = _cached_values(ws, ttl=ROW_LOOKUP_TTL)
     h = _get_header_map(ws)
-    idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-    all_vals = ws.get_all_values()[1:]
-    out = []
-    for ridx, r in enumerate(all_vals, start=2):
-        try:
-            if len(r) >= idx_rid and (r[idx_rid - 1] or "").strip() == rid:
-                out.append((ridx, r))
-        except Exception:
-            continue
-    return out
+    cols = _main_cols(h)
+    idx_rid = cols["rid"]
+    return [(ridx, all_vals[ridx - 1]) for ridx in _rid_row_index(all_vals, idx_rid).get(rid, [])]
 
 def _handle_cancel_request(event, text: str):
     """處理取消寄書請求（支援 ID、姓名、電話）"""
-    try:
-        uid = getattr(event.source, "user_id", "")
-        profile = line_bot_api.get_profile(uid)
-        operator = profile.display_name or "系統"
-    except Exception:
-        operator = "系統"
+    operator = _display_name(getattr(event.source, "user_id", ""))
     
     # 提取查詢條件
     target = _extract_cancel_target(text)
     
     if not target:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            text="請輸入查詢條件：\n• #取消寄書 R0001\n• #取消寄書 測試\n• #取消寄書 0930125812"
-        ))
+        _reply(event, "請輸入查詢條件：\n• #取消寄書 R0001\n• #取消寄書 測試\n• #取消寄書 0930125812")
         return
     
     try:
         ws = _ws(MAIN_SHEET_NAME)
+        _cached_values(ws, ttl=ROW_LOOKUP_TTL)  # 先讀整表（後續查找都會用到），表頭一併取得
         h = _get_header_map(ws)
+        cols = _main_cols(h)
         
         # 支援多種表頭名稱
-        idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-        idx_name = _col_idx(h, "學員姓名", _col_idx(h, "姓名", 4))
-        idx_book = _col_idx(h, "書籍名稱", 7)
-        idx_status = _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
+        idx_rid = cols["rid"]
+        idx_name = cols["name"]
+        idx_book = cols["book"]
+        idx_status = cols["status"]
         
         # 根據查詢類型處理
         if target["type"] == "id":
@@ -1491,14 +2033,14 @@ def _handle_cancel_request(event, text: str):
             all_rows = _collect_rows_by_rid(ws, rid)
             
             if not all_rows:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"找不到寄書ID：{rid}"))
+                _reply(event, f"找不到寄書ID：{rid}")
                 return
             
             # 檢查是否為待處理
             for row_i, r in all_rows:
                 status = (r[idx_status - 1] if len(r) >= idx_status else "").strip()
                 if status != "待處理":
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ {rid} 狀態為「{status}」，只能取消「待處理」的訂單"))
+                    _reply(event, f"❌ {rid} 狀態為「{status}」，只能取消「待處理」的訂單")
                     return
             
             # 取第一列的姓名
@@ -1513,7 +2055,7 @@ def _handle_cancel_request(event, text: str):
             
             if not row_i:
                 query_str = name or phone or "?"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 找不到「{query_str}」的待處理訂單"))
+                _reply(event, f"❌ 找不到「{query_str}」的待處理訂單")
                 return
             
             rid = (r[idx_rid - 1] if len(r) >= idx_rid else "").strip()
@@ -1524,26 +2066,25 @@ def _handle_cancel_request(event, text: str):
         book_list = "、".join([r[idx_book - 1] for _, r in all_rows if len(r) >= idx_book and r[idx_book - 1]])
         
         # 儲存待確認
-        _PENDING[event.source.user_id] = {
+        _set_pending(event.source.user_id, {
             "type": "cancel_order",
             "sheet": MAIN_SHEET_NAME,
             "rid": rid,
             "stu": stu_name,
             "book_list": book_list,
-            "rows": [row_i for row_i, _ in all_rows],
             "operator": operator,
             "idx": {
-                "H": _col_idx(h, "業務備註", _col_idx(h, "備註", 8)),
-                "L": _col_idx(h, "經手人", _col_idx(h, "已託運-經手人", 12)),
-                "M": _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
+                "H": cols["note"],
+                "L": cols["person"],
+                "M": cols["status"]
             }
-        }
+        })
         
         msg = f"確認刪除寄書？\n{rid}: {stu_name}\n書籍：{book_list}\n\n回覆「Y / YES / OK」確認；或回覆「N」取消。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        _reply(event, msg)
     except Exception as e:
         app.logger.error(f"[CANCEL] 處理失敗: {e}", exc_info=True)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 處理失敗: {e}"))
+        _reply(event, f"❌ 處理失敗: {e}")
 
 # ============================================
 # 刪除/取消出書
@@ -1553,38 +2094,41 @@ def _handle_delete_ship(event, text: str):
     rid = text.replace("#刪除出書", "").replace("#取消出書", "").strip()
     
     if not rid:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入寄書ID（例：#刪除出書 R0001）"))
+        _reply(event, "請輸入寄書ID（例：#刪除出書 R0001）")
         return
     
     try:
         ws = _ws(MAIN_SHEET_NAME)
-        h = _get_header_map(ws)
-        all_vals = ws.get_all_values()
-        
-        # 支援多種表頭名稱
-        idx_rid = _col_idx(h, "紀錄ID", _col_idx(h, "寄書ID", 1))
-        idx_tracking = _col_idx(h, "託運單號", _col_idx(h, "已託運-12碼單號", 11))
-        idx_date = _col_idx(h, "寄出日期", _col_idx(h, "已託運-寄出日期", 10))
-        idx_person = _col_idx(h, "經手人", _col_idx(h, "已託運-經手人", 12))
-        idx_status = _col_idx(h, "寄送狀態", _col_idx(h, "狀態", 13))
-        
-        found = False
-        for i, r in enumerate(all_vals[1:], start=2):
-            if len(r) >= idx_rid and r[idx_rid - 1] == rid:
-                _safe_update_cell(ws, i, idx_tracking, "")
-                _safe_update_cell(ws, i, idx_date, "")
-                _safe_update_cell(ws, i, idx_person, "")
-                _safe_update_cell(ws, i, idx_status, "待處理")
-                found = True
-        
-        if found:
+        # 讀取列號到寫入完成之間持有寫入鎖，避免並行插入讓列號位移而清到別筆訂單
+        with _sheet_write_lock(ws.title):
+            all_vals = _cached_values(ws, ttl=ROW_LOOKUP_TTL)
+            h = _get_header_map(ws)
+            cols = _main_cols(h)
+            
+            # 支援多種表頭名稱
+            idx_rid = cols["rid"]
+            idx_tracking = cols["tracking"]
+            idx_date = cols["ship_date"]
+            idx_person = cols["person"]
+            idx_status = cols["status"]
+            
+            # 所有要清除的儲存格收集後一次批次寫入
+            updates = []
+            for i in _rid_row_index(all_vals, idx_rid).get(rid, []):
+                updates.append({"range": rowcol_to_a1(i, idx_tracking), "values": [[""]]})
+                updates.append({"range": rowcol_to_a1(i, idx_date), "values": [[""]]})
+                updates.append({"range": rowcol_to_a1(i, idx_person), "values": [[""]]})
+                updates.append({"range": rowcol_to_a1(i, idx_status), "values": [["待處理"]]})
+            _safe_batch_update(ws, updates)
+        
+        if updates:
             app.logger.info(f"[DELETE_SHIP] 已撤銷出書: {rid}")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"✅ 已撤銷 {rid} 的出貨記錄"))
+            _reply(event, f"✅ 已撤銷 {rid} 的出貨記錄")
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"找不到寄書ID：{rid}"))
+            _reply(event, f"找不到寄書ID：{rid}")
     except Exception as e:
         app.logger.error(f"[DELETE_SHIP] 失敗: {e}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 處理失敗: {e}"))
+        _reply(event, f"❌ 處理失敗: {e}")
 
 # ============================================
 # 入庫功能
@@ -1595,18 +2139,13 @@ def _ensure_stockin_sheet():
 
 def _handle_stockin(event, text: str):
     """處理入庫（支援多種格式和錯誤引導）"""
-    try:
-        uid = getattr(event.source, "user_id", "")
-        profile = line_bot_api.get_profile(uid)
-        operator = profile.display_name or "系統"
-    except Exception:
-        operator = "系統"
+    operator = _display_name(getattr(event.source, "user_id", ""))
     
     # 支援多種指令
     lines_after = text.replace("#買書", "").replace("#入庫", "").replace("#進書", "").strip()
     
     if not lines_after:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入書名與數量，格式範例：\n• S2*1 或 S2 1\n• S3*2 或 S3 2\n• 雅思1*2 或 雅思1 2\n\n⚠️ 必須明確指定數量"))
+        _reply(event, "請輸入書名與數量，格式範例：\n• S2*1 或 S2 1\n• S3*2 或 S3 2\n• 雅思1*2 或 雅思1 2\n\n⚠️ 必須明確指定數量")
         return
     
     # 解析書名與數量（支援多種格式）
@@ -1621,12 +2160,11 @@ def _handle_stockin(event, text: str):
         book_candidate = None
         qty_str = None
         
-        # 優先 1：檢查明確分隔符號（*、×、x、X）
-        if re.search(r'[*×xX]', line):
-            parts = re.split(r'[*×xX]', line, maxsplit=1)
-            if len(parts) == 2:
-                book_candidate = parts[0].strip()
-                qty_str = parts[1].strip()
+        # 優先 1：檢查明確分隔符號（*、×、x、X）；split 一次即可判斷有無分隔符號
+        parts = _RE_QTY_SEP.split(line, maxsplit=1)
+        if len(parts) == 2:
+            book_candidate = parts[0].strip()
+            qty_str = parts[1].strip()
         
         # 優先 2：空格分隔（最後一段是數字）
         elif ' ' in line:
@@ -1662,18 +2200,18 @@ def _handle_stockin(event, text: str):
     
     # 情況 1：完全找不到任何書
     if not items and not errors:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 無法辨識書名或數量\n\n請使用格式：\n• 書名*數量（如 S2*1）\n• 書名 數量（如 S2 1）\n\n或使用「#查書名」確認正確書名"))
+        _reply(event, "❌ 無法辨識書名或數量\n\n請使用格式：\n• 書名*數量（如 S2*1）\n• 書名 數量（如 S2 1）\n\n或使用「#查書名」確認正確書名")
         return
     
     # 情況 2：有錯誤（找不到的書名）
     if errors:
         # 儲存待修正狀態
-        _PENDING[event.source.user_id] = {
+        _set_pending(event.source.user_id, {
             "type": "stockin_correction",
             "operator": operator,
             "items": items,  # 已找到的書
             "errors": errors  # 待修正的書
-        }
+        })
         
         # 建立錯誤訊息
         msg_lines = []
@@ -1701,7 +2239,7 @@ def _handle_stockin(event, text: str):
         msg_lines.append("• 或輸入正確書名")
         msg_lines.append("• 或回覆「取消」放棄")
         
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="\n".join(msg_lines)))
+        _reply(event, "\n".join(msg_lines))
         return
     
     # 情況 3：全部找到，合併相同書名
@@ -1713,16 +2251,16 @@ def _handle_stockin(event, text: str):
     has_negative = any(it["qty"] < 0 for it in final_items)
     
     # 儲存待確認
-    _PENDING[event.source.user_id] = {
+    _set_pending(event.source.user_id, {
         "type": "stock_in_confirm",
         "operator": operator,
         "items": final_items
-    }
+    })
     
     lines = [f"• {it['name']} × {it['qty']}" for it in final_items]
     suffix = "\n\n※ 含負數（自動標示來源：盤點調整）" if has_negative else ""
     msg = "請確認入庫項目：\n" + "\n".join(lines) + suffix + "\n\n回覆「OK / YES / Y」確認；或回覆「N」取消。"
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    _reply(event, msg)
 
 def _handle_stockin_correction(event, text: str) -> bool:
     """處理入庫修正流程"""
@@ -1736,8 +2274,8 @@ def _handle_stockin_correction(event, text: str) -> bool:
     
     # 檢查是否取消
     if user_input.upper() in ("取消", "N", "NO", ""):
-        _PENDING.pop(event.source.user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消入庫"))
+        _drop_pending(event.source.user_id)
+        _reply(event, "已取消入庫")
         return True
     
     errors = pend.get("errors", [])
@@ -1775,7 +2313,7 @@ def _handle_stockin_correction(event, text: str) -> bool:
             
             return True
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 請輸入 1-{len(suggestions)} 的數字"))
+            _reply(event, f"❌ 請輸入 1-{len(suggestions)} 的數字")
             return True
     
     # 情況 2：使用者直接輸入書名
@@ -1806,9 +2344,9 @@ def _handle_stockin_correction(event, text: str) -> bool:
             for i, sug in enumerate(suggestions[:3], start=1):
                 msg_lines.append(f"{i}. {sug}")
             msg_lines.append("\n請輸入數字選擇，或重新輸入正確書名")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="\n".join(msg_lines)))
+            _reply(event, "\n".join(msg_lines))
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 找不到「{user_input}」，請使用「#查書名」確認正確書名，或回覆「取消」"))
+            _reply(event, f"❌ 找不到「{user_input}」，請使用「#查書名」確認正確書名，或回覆「取消」")
         return True
 
 def _show_next_stockin_error(event, pend):
@@ -1828,7 +2366,7 @@ def _show_next_stockin_error(event, pend):
         msg_lines.append("⚠️ 找不到類似書籍")
         msg_lines.append("請輸入正確書名，或回覆「取消」")
     
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="\n".join(msg_lines)))
+    _reply(event, "\n".join(msg_lines))
 
 def _finalize_stockin_items(event, pend):
     """完成入庫修正，進入最終確認"""
@@ -1848,16 +2386,17 @@ def _finalize_stockin_items(event, pend):
     lines = [f"• {it['name']} × {it['qty']}" for it in final_items]
     suffix = "\n\n※ 含負數（自動標示來源：盤點調整）" if has_negative else ""
     msg = "請確認入庫項目：\n" + "\n".join(lines) + suffix + "\n\n回覆「OK / YES / Y」確認；或回覆「N」取消。"
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    _reply(event, msg)
 
 def _write_stockin_rows(operator: str, items: list):
     """寫入入庫記錄"""
     ws = _ensure_stockin_sheet()
+    today = today_str()  # 同一批入庫共用一個日期（也避免跨午夜時同批日期不一致）
     rows = []
     for it in items:
         qty = int(it["qty"])
         source = "購買" if qty >= 0 else "盤點調整"
-        rows.append([today_str(), operator, it["name"], qty, source, ""])
+        rows.append([today, operator, it["name"], qty, source, ""])
     _safe_append_rows(ws, rows)
 
 # ============================================
@@ -1878,13 +2417,13 @@ def _handle_search_books(event, text: str):
             "• #查書名 兒童\n\n"
             "系統會列出所有符合的書籍名稱"
         )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        _reply(event, msg)
         return
     
     results = _search_books_by_keyword(keyword)
     
     if not results:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"找不到包含「{keyword}」的書籍"))
+        _reply(event, f"找不到包含「{keyword}」的書籍")
         return
     
     # 依語別分組
@@ -1912,7 +2451,7 @@ def _handle_search_books(event, text: str):
     if len(msg) > 4500:
         msg = msg[:4500] + "\n\n⚠️ 結果過多，已截斷。請使用更精確的關鍵字。"
     
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    _reply(event, msg)
 
 # ============================================
 # 整理寄書（保留原功能）
@@ -1929,10 +2468,10 @@ def _handle_organize_order(event, text: str):
     biz_note = data.get("業務備註", "").strip()
     
     if not all([name, phone, address, book_raw]):
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 資料不完整（需：姓名、電話、地址、書籍名稱）"))
+        _reply(event, "❌ 資料不完整（需：姓名、電話、地址、書籍名稱）")
         return
     
-    _PENDING[event.source.user_id] = {
+    _set_pending(event.source.user_id, {
         "type": "organize_order_confirm",
         "data": {
             "name": name,
@@ -1941,10 +2480,10 @@ def _handle_organize_order(event, text: str):
             "book_raw": book_raw,
             "biz_note": biz_note
         }
-    }
+    })
     
     msg = f"確認建立寄書？\n姓名：{name}\n電話：{phone}\n地址：{address}\n書籍：{book_raw}\n\n回覆「Y / YES / OK」確認；或回覆「N」取消。"
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    _reply(event, msg)
 
 # ============================================
 # 處理待確認回答（修復 S2：移除重複程式碼）
@@ -1956,6 +2495,11 @@ def _handle_pending_answer(event, text: str) -> bool:
     if not pend:
         return False
     
+    # 過期的確認流程視同不存在（逐本選書有自己的超時提示）
+    if pend.get("type") != "book_selection_step" and time.time() > pend["expire_at"]:
+        _claim_pending(user_id, pend)
+        return False
+    
     # 處理逐本選書流程（新增）
     if pend.get("type") == "book_selection_step":
         return _handle_book_selection_step(event, text)
@@ -1964,8 +2508,8 @@ def _handle_pending_answer(event, text: str) -> bool:
     
     # 取消
     if ans == "N":
-        _PENDING.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消。"))
+        _drop_pending(user_id)
+        _reply(event, "已取消。")
         return True
     
     # 處理書籍選擇（數字）
@@ -1978,61 +2522,82 @@ def _handle_pending_answer(event, text: str) -> bool:
     
     # 重新輸入
     if ans in ("重新輸入", "RETRY", "REDO"):
-        _PENDING.pop(event.source.user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已清除，請重新輸入完整 #寄書 資料"))
+        _drop_pending(event.source.user_id)
+        _reply(event, "已清除，請重新輸入完整 #寄書 資料")
         return True
     
     # 確認
     if ans not in ("Y", "YES", "OK"):
         return False
     
-    # 取消寄書
-    if pend["type"] == "cancel_order":
-        ws = _ws(pend["sheet"])
-        idxH = pend["idx"]["H"]
-        idxL = pend["idx"]["L"]
-        idxM = pend["idx"]["M"]
-        
-        append_note = f"[已刪除 {now_str_min()}]"
-        for row_i in pend["rows"]:
-            try:
-                curr_h = ws.cell(row_i, idxH).value or ""
-            except Exception:
-                curr_h = ""
-            new_h = (curr_h + " " + append_note).strip() if curr_h else append_note
-            _safe_update_cell(ws, row_i, idxH, new_h)
-            _safe_update_cell(ws, row_i, idxL, pend["operator"])
-            _safe_update_cell(ws, row_i, idxM, "已刪除")
-        
-        msg = f"✅ 已刪除整筆寄書（{pend['rid']}）：{pend['stu']} 的 {pend['book_list']}"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
-        _PENDING.pop(event.source.user_id, None)
-        return True
-    
-    # 入庫確認
-    if pend["type"] == "stock_in_confirm":
-        _write_stockin_rows(pend["operator"], pend["items"])
-        lines = [f"{it['name']} × {it['qty']}" for it in pend["items"]]
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="✅ 入庫完成：\n" + "\n".join(lines)))
-        _PENDING.pop(event.source.user_id, None)
-        return True
+    confirm = _CONFIRM_HANDLERS.get(pend["type"])
+    if not confirm:
+        return False
     
-    # 整理寄書確認（修復 S2：只保留一份）
-    if pend["type"] == "organize_order_confirm":
-        data = pend["data"]
-        fake_text = (
-            "#寄書\n"
-            f"姓名：{data['name']}\n"
-            f"電話：{data['phone']}\n"
-            f"寄送地址：{data['address']}\n"
-            f"書籍名稱：{data['book_raw']}\n"
-            f"業務備註：{data['biz_note']}"
-        )
-        _handle_new_order(event, fake_text)
-        _PENDING.pop(event.source.user_id, None)
+    # 先認領再寫入（寫入交給背景執行緒，重複的確認訊息直接忽略）
+    if not _claim_pending(user_id, pend):
         return True
-    
-    return False
+    _defer(event, confirm, pend)
+    return True
+
+def _confirm_cancel_order(event, pend: Dict[str, Any]):
+    """確認取消寄書：備註加上刪除標記，並寫入經手人與狀態"""
+    ws = _ws(pend["sheet"])
+    idxH = pend["idx"]["H"]
+    idxL = pend["idx"]["L"]
+    idxM = pend["idx"]["M"]
+    
+    append_note = f"[已刪除 {now_str_min()}]"
+    with _sheet_write_lock(ws.title):
+        # 詢問後到回覆 Y 之間可能有新訂單插入，列號在寫入鎖內依寄書ID重新定位
+        idx_rid = _main_cols(_get_header_map(ws))["rid"]
+        rows = _rid_row_index(_cached_columns(ws, (idx_rid,), ttl=ROW_LOOKUP_TTL), 1).get(pend["rid"], [])
+        if not rows:
+            _reply(event, f"找不到寄書ID：{pend['rid']}")
+            return
+        # 一次讀回所有列目前的備註，避免逐格 ws.cell 往返
+        note_ranges = [rowcol_to_a1(row_i, idxH) for row_i in rows]
+        try:
+            curr_notes = ws.batch_get(note_ranges)
+        except Exception:
+            curr_notes = [[] for _ in note_ranges]
+        updates = []
+        for row_i, note_range, note_vals in zip(rows, note_ranges, curr_notes):
+            curr_h = (note_vals[0][0] if note_vals and note_vals[0] else "") or ""
+            new_h = (curr_h + " " + append_note).strip() if curr_h else append_note
+            updates.append({"range": note_range, "values": [[new_h]]})
+            updates.append({"range": rowcol_to_a1(row_i, idxL), "values": [[pend["operator"]]]})
+            updates.append({"range": rowcol_to_a1(row_i, idxM), "values": [["已刪除"]]})
+        _safe_batch_update(ws, updates)
+    
+    msg = f"✅ 已刪除整筆寄書（{pend['rid']}）：{pend['stu']} 的 {pend['book_list']}"
+    _reply(event, msg)
+
+def _confirm_stockin(event, pend: Dict[str, Any]):
+    """確認入庫：寫入入庫明細"""
+    _write_stockin_rows(pend["operator"], pend["items"])
+    lines = [f"{it['name']} × {it['qty']}" for it in pend["items"]]
+    _reply(event, "✅ 入庫完成：\n" + "\n".join(lines))
+
+def _confirm_organize_order(event, pend: Dict[str, Any]):
+    """確認整理寄書：組回 #寄書 格式後走一般建單流程（修復 S2：只保留一份）"""
+    data = pend["data"]
+    fake_text = (
+        "#寄書\n"
+        f"姓名：{data['name']}\n"
+        f"電話：{data['phone']}\n"
+        f"寄送地址：{data['address']}\n"
+        f"書籍名稱：{data['book_raw']}\n"
+        f"業務備註：{data['biz_note']}"
+    )
+    _handle_new_order(event, fake_text)
+
+# 待確認類型 -> 回覆 Y 後執行的動作
+_CONFIRM_HANDLERS = {
+    "cancel_order": _confirm_cancel_order,
+    "stock_in_confirm": _confirm_stockin,
+    "organize_order_confirm": _confirm_organize_order,
+}
 
 def _handle_book_selection(event, choice: int) -> bool:
     """處理書籍選擇（新功能）"""
@@ -2062,25 +2627,27 @@ def _handle_book_selection(event, choice: int) -> bool:
                 new_errors = _validate_order_data(validation_data)
                 
                 if not new_errors:
-                    # 無錯誤，直接建立訂單
-                    _create_order_confirmed(
+                    # 無錯誤，認領後交給背景執行緒建立訂單
+                    if not _claim_pending(event.source.user_id, pend):
+                        return True
+                    _defer(
                         event,
+                        _create_order_confirmed,
                         validation_data["name"],
                         validation_data["phone"],
                         validation_data["address"],
                         new_books,
                         pend.get("biz_note", "")
                     )
-                    _PENDING.pop(event.source.user_id, None)
                 else:
                     # 還有其他錯誤，繼續引導
                     pend["errors"] = new_errors
                     error_msg = _format_validation_errors(new_errors)
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=error_msg))
+                    _reply(event, error_msg)
                 
                 return True
     
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 無效的選項"))
+    _reply(event, "❌ 無效的選項")
     return True
 
 # ============================================
@@ -2088,45 +2655,28 @@ def _handle_book_selection(event, choice: int) -> bool:
 # ============================================
 def _handle_classplus_order(event, text: str):
     """處理 #訂課 指令"""
-    uid = getattr(event.source, "user_id", "")
     student_info = parse_student_info(text)
 
     if not student_info.get("name"):
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=(
-                "❌ 格式錯誤，請依以下格式輸入：\n\n"
-                "#訂課\n"
-                "學生姓名：\n"
-                "學生程度：\n"
-                "信箱：\n"
-                "學習備註："
-            ))
-        )
+        _reply(event, (
+            "❌ 格式錯誤，請依以下格式輸入：\n\n"
+            "#訂課\n"
+            "學生姓名：\n"
+            "學生程度：\n"
+            "信箱：\n"
+            "學習備註："
+        ))
         return
 
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=f"⏳ 正在處理 {student_info['name']} 的訂課，請稍候...")
-    )
+    _defer(event, _run_classplus_order, student_info, ack=f"⏳ 正在處理 {student_info['name']} 的訂課，請稍候...")
 
+def _run_classplus_order(event, student_info: dict):
+    """背景執行 ClassPlus 操作並 push 結果"""
     result = run_classplus_task(student_info)
     msg = format_result_message(result, student_info)
 
     try:
-        if result.get("screenshot"):
-            import io
-            from linebot.models import ImageSendMessage
-            # 上傳截圖並回傳
-            line_bot_api.push_message(
-                getattr(event.source, "group_id", uid) or uid,
-                TextSendMessage(text=msg)
-            )
-        else:
-            line_bot_api.push_message(
-                getattr(event.source, "group_id", uid) or uid,
-                TextSendMessage(text=msg)
-            )
+        _reply(event, msg)
     except Exception as e:
         app.logger.error(f"[CLASSPLUS] 回傳訊息失敗: {e}")
 
@@ -2138,7 +2688,8 @@ def _handle_classplus_order(event, text: str):
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    if LOG_WEBHOOK_RAW:
+        app.logger.info("Request body: %s", body)
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
@@ -2148,24 +2699,81 @@ def callback():
         return "OK"
     return "OK"
 
+def _handle_reload_caches(event, text: str = ""):
+    """管理員指令：清除所有快取，並在背景重新載入書目與白名單（試算表手動修改後立即生效）"""
+    uid = getattr(event.source, "user_id", "")
+    if uid not in ADMIN_USER_IDS:
+        _reply(event, "❌ 此指令僅限管理員使用")
+        return
+    
+    _invalidate_header_cache()
+    _WS_CACHE.clear()
+    _PROFILE_CACHE.clear()
+    # 主表寫入後通常只剩欄位快取（全表快取已清掉），所有讀過的工作表都要換世代
+    names = set(_SHEET_CACHE) | set(_SHEET_GEN) | {key[0] for key in list(_COLUMN_CACHE)}
+    for name in names:
+        _invalidate_sheet_cache(name)
+    _COLUMN_CACHE.clear()
+    _reset_rid_counter()
+    app.logger.info(f"[ADMIN] {uid} 重新載入快取")
+    _defer(event, _reload_sheet_caches, ack="⏳ 已清除快取，重新載入中...")
+
+def _reload_sheet_caches(event):
+    """背景重新讀取書目與白名單，完成後回報數量"""
+    books = _load_books(force=True)
+    allowed = _load_whitelist(force=True)
+    _reply(event, f"✅ 已重新載入快取\n書目：{len(books)} 本\n白名單：{len(allowed)} 人")
+
+def _handle_start_ocr(event, text: str):
+    """#出書：啟用此使用者的出書 OCR 時段"""
+    _start_ocr_session(getattr(event.source, "user_id", ""))
+    _reply(event, f"已啟用出書OCR（{OCR_SESSION_TTL_MIN} 分鐘）。請上傳出貨單照片。")
+
+# 指令 -> (處理函式, 是否交給背景執行緒)；各指令之間沒有前綴重疊
+_TEXT_COMMANDS = {
+    "#訂課": (_handle_classplus_order, False),
+    "#查書名": (_handle_search_books, False),
+    "#整理寄書": (_handle_organize_order, False),
+    "#寄書": (_handle_new_order, True),
+    "#查詢寄書": (_handle_query, True),
+    "#查寄書": (_handle_query, True),
+    "#取消寄書": (_handle_cancel_request, True),
+    "#刪除寄書": (_handle_cancel_request, True),
+    "#刪除出書": (_handle_delete_ship, True),
+    "#取消出書": (_handle_delete_ship, True),
+    "#出書": (_handle_start_ocr, False),
+    "#買書": (_handle_stockin, False),
+    "#入庫": (_handle_stockin, False),
+    "#進書": (_handle_stockin, False),
+    "#重新載入": (_handle_reload_caches, False),
+}
+
+def _match_text_command(text: str):
+    """找出文字對應的指令（先以第一個詞查表，指令後直接接內容時再逐一比對前綴）"""
+    if not text.startswith("#"):
+        return None
+    hit = _TEXT_COMMANDS.get(text.split(None, 1)[0])
+    if hit:
+        return hit
+    for prefix, cmd in _TEXT_COMMANDS.items():
+        if text.startswith(prefix):
+            return cmd
+    return None
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     """處理文字訊息"""
+    if _is_redelivery(event):
+        app.logger.info(f"[CALLBACK] 略過重送事件 msg_id={event.message.id}")
+        return
     text = (event.message.text or "").strip()
     
     # #我的ID（不受白名單限制）
     if text.startswith("#我的ID"):
         uid = getattr(event.source, "user_id", "")
+        name = _display_name(uid, "LINE使用者")
         try:
-            profile = line_bot_api.get_profile(uid)
-            name = profile.display_name or "LINE使用者"
-        except Exception:
-            name = "LINE使用者"
-        try:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=f"你的 ID：\n{uid}\n顯示名稱：{name}\n\n請提供給管理員加入白名單。")
-            )
+            _reply(event, f"你的 ID：\n{uid}\n顯示名稱：{name}\n\n請提供給管理員加入白名單。")
         except Exception:
             pass
         if uid:
@@ -2181,66 +2789,43 @@ def handle_text_message(event):
         return
     
     # 處理指令
-    if text.startswith("#訂課"):
-        _handle_classplus_order(event, text)
-        return
-
-    if text.startswith("#查書名"):
-        _handle_search_books(event, text)
-        return
-    
-    if text.startswith("#整理寄書"):
-        _handle_organize_order(event, text)
-        return
-    
-    if text.startswith("#寄書"):
-        _handle_new_order(event, text)
-        return
-    
-    if text.startswith("#查詢寄書") or text.startswith("#查寄書"):
-        _handle_query(event, text)
-        return
-    
-    if text.startswith("#取消寄書") or text.startswith("#刪除寄書"):
-        _handle_cancel_request(event, text)
-        return
-    
-    if text.startswith("#刪除出書") or text.startswith("#取消出書"):
-        _handle_delete_ship(event, text)
-        return
-    
-    if text.startswith("#出書"):
-        _start_ocr_session(getattr(event.source, "user_id", ""))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"已啟用出書OCR（{OCR_SESSION_TTL_MIN} 分鐘）。請上傳出貨單照片。"))
-        return
-    
-    if text.startswith("#買書") or text.startswith("#入庫") or text.startswith("#進書"):
-        _handle_stockin(event, text)
-        return
-    
-    # 其他文字不處理
+    cmd = _match_text_command(text)
+    if not cmd:
+        return  # 其他文字不處理
+    func, deferred = cmd
+    if deferred:
+        _defer(event, func, text)
+    else:
+        func(event, text)
 
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
     """處理圖片訊息"""
+    if _is_redelivery(event):
+        app.logger.info(f"[CALLBACK] 略過重送事件 msg_id={event.message.id}")
+        return
     if not _ensure_authorized(event, scope="image"):
         return
     
     uid = getattr(event.source, "user_id", "")
-    if not _has_ocr_session(uid):
+    # 一個會話只處理一張圖，受理時即關閉，避免背景處理期間重複受理
+    if not _take_ocr_session(uid):
         return
-    
+    _defer(event, _process_ocr_image, ack="⏳ 已收到圖片，辨識中...")
+
+def _process_ocr_image(event):
+    """背景執行 OCR 辨識並寫回出貨資料"""
+    uid = getattr(event.source, "user_id", "")
     try:
         app.logger.info(f"[IMG] 收到圖片 user_id={uid} msg_id={event.message.id}")
-        img_bytes = _download_line_image_bytes(event.message.id)
         
+        # 先確認 Vision 可用再下載，避免白白傳輸整張圖片
         if not _vision_client:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="❌ OCR 錯誤：Vision 未初始化（請設定 GOOGLE_SERVICE_ACCOUNT_JSON_NEW 並啟用 Vision API）。")
-            )
+            _reply(event, "❌ OCR 錯誤：Vision 未初始化（請設定 GOOGLE_SERVICE_ACCOUNT_JSON_NEW 並啟用 Vision API）。")
             return
         
+        img_bytes = _download_line_image_bytes(event.message.id)
+        
         text = _ocr_text_from_bytes(img_bytes)
         if LOG_OCR_RAW:
             app.logger.info(f"[OCR_TEXT]\n{text}")
@@ -2251,16 +2836,29 @@ def handle_image_message(event):
         if leftovers:
             resp += "\n\n❗以下項目需人工檢核：\n" + "\n".join(leftovers[:MAX_LEFTOVER_ITEMS])
         
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=resp))
+        _reply(event, resp)
     except Exception as e:
         code = datetime.now(TZ).strftime("%Y%m%d%H%M%S")
         app.logger.exception("[OCR_ERROR]")
         try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ OCR 錯誤（代碼 {code}）：{e}"))
+            _reply(event, f"❌ OCR 錯誤（代碼 {code}）：{e}")
         except Exception:
             pass
-    finally:
-        _clear_ocr_session(uid)
+
+def _warm_caches():
+    """啟動後在背景預載書目、郵遞區號、白名單與主表表頭，第一則訊息不必等讀表"""
+    if ss is None:
+        return
+    try:
+        _load_books()
+        _load_zip_index()
+        _load_whitelist()
+        _get_header_map(_ws(MAIN_SHEET_NAME))
+        app.logger.info("[STARTUP] 快取預載完成")
+    except Exception as e:
+        app.logger.warning(f"[STARTUP] 快取預載失敗: {e}")
+
+_EXECUTOR.submit(_warm_caches)
 
 @app.route("/", methods=["GET"])
 def index():
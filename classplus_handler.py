@@ -25,19 +25,21 @@ CLASSPLUS_PASSWORD = os.getenv("CLASSPLUS_PASSWORD", "")
 CHROMIUM_PATH = "/usr/bin/chromium"
 
 
+# 學生資料欄位（模組載入時編譯一次）
+_STUDENT_PATTERNS = {
+    "name":    re.compile(r"學生姓名[：:]\s*(.+)"),
+    "level":   re.compile(r"學生程度[：:]\s*(.+)"),
+    "email":   re.compile(r"信箱[：:]\s*(.+)"),
+    "note":    re.compile(r"學習備註[：:]\s*(.+)"),
+}
+
+
 def parse_student_info(text: str) -> dict:
     """解析 LINE 訊息中的學生資料"""
     data = {}
 
-    patterns = {
-        "name":    r"學生姓名[：:]\s*(.+)",
-        "level":   r"學生程度[：:]\s*(.+)",
-        "email":   r"信箱[：:]\s*(.+)",
-        "note":    r"學習備註[：:]\s*(.+)",
-    }
-
-    for key, pattern in patterns.items():
-        m = re.search(pattern, text)
+    for key, pattern in _STUDENT_PATTERNS.items():
+        m = pattern.search(text)
         if m:
             data[key] = m.group(1).strip()
 
@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+# gunicorn 啟動時自動讀取（Dockerfile: CMD ["gunicorn", "app:app"]）
+#
+# webhook 主要時間花在等待 LINE / Sheets / Vision 回應，改用 gthread 讓同一個行程內多個執行緒分攤。
+# 注意：只能開 1 個 worker —— 待確認流程（_PENDING）、寄書ID計數器、OCR 時段都存在行程記憶體中，
+# 多個 worker 會讓使用者的「Y」落到另一個行程，也可能產生重複的寄書ID。
+# 也不開 preload_app：背景執行緒（候選名單回寫、執行緒池）在 fork 之後不會存在於 worker 中。
+
+import os
+
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+keepalive = 30
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))